@@ -0,0 +1,136 @@
+import datetime
+import threading
+import time
+
+import emdash.config
+
+##### Bandwidth limits #####
+
+def parse_rate(value):
+    """Parse a rate in bytes/sec, with an optional K, M or G suffix. 0 or empty is unlimited."""
+    value = unicode(value or '').strip().upper()
+    if not value:
+        return 0
+    scale = 1
+    for suffix, s in [('K', 1024), ('M', 1024**2), ('G', 1024**3)]:
+        if value.endswith(suffix):
+            value = value[:-1]
+            scale = s
+    return int(float(value) * scale)
+
+def parse_schedule(value):
+    """Parse a schedule like "08:00-18:00=10M,18:00-08:00=0" into (start, end, rate) tuples.
+
+    Start and end are minutes after midnight; a window may wrap past midnight.
+    """
+    ret = []
+    for item in unicode(value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        window, _, rate = item.partition('=')
+        start, _, end = window.partition('-')
+        ret.append((_parse_minutes(start), _parse_minutes(end), parse_rate(rate)))
+    return ret
+
+def _parse_minutes(value):
+    h, _, m = value.strip().partition(':')
+    return int(h) * 60 + int(m or 0)
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Callers take tokens up front and may drive the bucket negative; each
+    caller then sleeps off its share of the debt, outside the lock. This
+    keeps concurrent transfers fair and allows sends larger than the burst.
+    """
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.t = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self._refill()
+            self.rate = rate or 0
+            # Default burst: a quarter second of traffic.
+            self.burst = burst or self.rate / 4
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, count):
+        with self.lock:
+            if not self.rate:
+                return 0
+            self._refill()
+            self.tokens -= count
+            wait = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def _refill(self):
+        now = time.time()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+class Limiter(object):
+    """A TokenBucket whose rate follows a base rate and a time-of-day schedule."""
+    # Seconds between schedule checks.
+    interval = 10
+
+    def __init__(self, rate=0, schedule=None):
+        self.bucket = TokenBucket()
+        self.rate = rate
+        self.schedule = schedule or []
+        self._checked = 0
+        self.update()
+
+    def set_rate(self, rate):
+        """Change the base rate (bytes/sec, 0 for unlimited); takes effect immediately."""
+        self.rate = rate or 0
+        self.update()
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule or []
+        self.update()
+
+    def current_rate(self, now=None):
+        now = now or datetime.datetime.now()
+        minutes = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= end and start <= minutes < end:
+                return rate
+            if start > end and (minutes >= start or minutes < end):
+                return rate
+        return self.rate
+
+    def update(self):
+        self._checked = time.time()
+        rate = self.current_rate()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+
+    def consume(self, count):
+        if self.schedule and time.time() - self._checked > self.interval:
+            self.update()
+        return self.bucket.consume(count)
+
+# Process-wide limiters; every transfer goes through one of these.
+upload = Limiter()
+download = Limiter()
+
+def set_limit(direction, rate):
+    """Live adjustment, e.g. from the options dialog: set_limit('upload', '10M')."""
+    limiter = {'upload':upload, 'download':download}[direction]
+    limiter.set_rate(parse_rate(rate))
+
+def configure():
+    """Set the limits and schedules from the current config."""
+    upload.set_schedule(parse_schedule(emdash.config.get('schedule_upload')))
+    upload.set_rate(parse_rate(emdash.config.get('limit_upload')))
+    download.set_schedule(parse_schedule(emdash.config.get('schedule_download')))
+    download.set_rate(parse_rate(emdash.config.get('limit_download')))
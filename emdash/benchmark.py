@@ -0,0 +1,376 @@
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import emdash
+import emdash.config
+import emdash.engine
+import emdash.handlers
+import emdash.emhandlers
+
+##### Synthetic data #####
+
+# Detector-like 16-bit pixels: a random low byte and a mostly-zero high
+# byte, so the data is about as compressible as real counting-mode frames.
+_highbyte = ''.join(chr(0) if i < 224 else chr(1) for i in range(256))
+
+def pixels(count):
+    data = bytearray(count*2)
+    data[0::2] = os.urandom(count)
+    data[1::2] = os.urandom(count).translate(_highbyte)
+    return str(data)
+
+def write_pixels(f, count, blocksize=2*1024*1024):
+    while count > 0:
+        n = min(blocksize, count)
+        f.write(pixels(n))
+        count -= n
+
+def mrc_header(nx, ny, nz, extheadersize=0, serialem=None):
+    """MRC2000 header for 16-bit images; serialem=(bytespersection, flags) adds the IMOD fields."""
+    h = bytearray(1024)
+    struct.pack_into('<10i', h, 0, nx, ny, nz, 1, 0, 0, 0, nx, ny, nz)
+    struct.pack_into('<6f', h, 40, nx, ny, nz, 90, 90, 90)
+    struct.pack_into('<3i3fii', h, 64, 1, 2, 3, 0, 65535, 128, 0, extheadersize)
+    if serialem:
+        struct.pack_into('<h', h, 96, 0)
+        struct.pack_into('<hh', h, 128, *serialem)
+    h[208:212] = 'MAP '
+    struct.pack_into('<4si', h, 212, '\x44\x44\x00\x00', 1)
+    label = 'emdash benchmark'.ljust(80)
+    h[224:304] = label
+    return str(h)
+
+def write_mrc(filename, nx, ny, nz=1):
+    with open(filename, 'wb') as f:
+        f.write(mrc_header(nx, ny, nz))
+        write_pixels(f, nx*ny*nz)
+
+def write_serialem(filename, nx, ny, nz):
+    # Extended header: tilt angle (x100) and magnification (/10) per section.
+    flags = 1 | 8
+    section = struct.calcsize('<hh')
+    ext = ''.join(struct.pack('<hh', int((-60 + 120.0*i/max(nz-1, 1))*100), 5000) for i in range(nz))
+    with open(filename, 'wb') as f:
+        f.write(mrc_header(nx, ny, nz, extheadersize=len(ext), serialem=(section, flags)))
+        f.write(ext)
+        write_pixels(f, nx*ny*nz)
+
+def write_tiff(filename, nx, ny):
+    # Baseline TIFF: one uncompressed strip of 16-bit grayscale.
+    entries = [
+        (256, 4, nx),       # ImageWidth
+        (257, 4, ny),       # ImageLength
+        (258, 3, 16),       # BitsPerSample
+        (259, 3, 1),        # Compression: none
+        (262, 3, 1),        # Photometric: min-is-black
+        (273, 4, 0),        # StripOffsets, set below
+        (277, 3, 1),        # SamplesPerPixel
+        (278, 4, ny),       # RowsPerStrip
+        (279, 4, nx*ny*2),  # StripByteCounts
+    ]
+    ifdsize = 2 + 12*len(entries) + 4
+    offset = 8 + ifdsize
+    ifd = struct.pack('<H', len(entries))
+    for tag, type_, value in entries:
+        if tag == 273:
+            value = offset
+        fmt = '<HHIHxx' if type_ == 3 else '<HHII'
+        ifd += struct.pack(fmt, tag, type_, 1, value)
+    ifd += struct.pack('<I', 0)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<2sHI', 'II', 42, 8))
+        f.write(ifd)
+        write_pixels(f, nx*ny)
+
+def _dm3_group(tags):
+    ret = struct.pack('>BBi', 0, 1, len(tags))
+    for label, value in tags:
+        if isinstance(value, list):
+            ret += struct.pack('>Bh', 20, len(label)) + label + _dm3_group(value)
+        else:
+            ret += struct.pack('>Bh', 21, len(label)) + label + value
+    return ret
+
+def _dm3_long(value):
+    return '%%%%' + struct.pack('>2i', 1, 3) + struct.pack('<i', value)
+
+def _dm3_ulong(value):
+    return '%%%%' + struct.pack('>2i', 1, 5) + struct.pack('<I', value)
+
+def write_dm3(filename, nx, ny):
+    # DigitalMicrograph 3: big-endian tag structure, little-endian data.
+    # The image array is written last so it can be streamed.
+    count = nx*ny
+    head = '%%%%' + struct.pack('>4i', 3, 20, 4, count)
+    image = [
+        ('DataType', _dm3_long(10)),
+        ('PixelDepth', _dm3_long(2)),
+        ('Dimensions', [('', _dm3_ulong(nx)), ('', _dm3_ulong(ny))]),
+    ]
+    body = _dm3_group([('ImageList', [('', [('ImageData', image + [('Data', head)])])])])
+    tail = '\x00' * 8
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('>3i', 3, len(body) + count*2 + len(tail), 1))
+        f.write(body)
+        write_pixels(f, count)
+        f.write(tail)
+
+def write_ddd(dirname, nx, ny, frames):
+    # A DDD exposure: info.txt, summed and final images, and raw frames.
+    os.makedirs(dirname)
+    info = {
+        'Binning X': 1,
+        'Binning Y': 1,
+        'Exposure Mode': 'Normal',
+        'Preexposure Time in Seconds': 0.0,
+        'Raw Frames Filename Suffix': 'tif',
+        'Raw Frames Type': 'Tiff',
+        'Save Raw Frames': 'Enabled',
+        'Save Summed Image': 'Enabled',
+        'Temperature Detector (Celsius)': -20.0,
+    }
+    with open(os.path.join(dirname, 'info.txt'), 'w') as f:
+        for k, v in sorted(info.items()):
+            f.write('%s=%s\n'%(k, v))
+    write_tiff(os.path.join(dirname, 'SumImage.tif'), nx, ny)
+    write_tiff(os.path.join(dirname, 'FinalImage.tif'), nx, ny)
+    for i in range(frames):
+        write_tiff(os.path.join(dirname, 'RawImage_%d.tif'%i), nx, ny)
+    return os.path.join(dirname, 'info.txt')
+
+# Dataset: (handler, function(dirname, index, ns) returning the name to upload).
+datasets = {
+    'mrc': ('ccd', lambda d, i, ns: _write(write_mrc, os.path.join(d, 'image_%04d.mrc'%i), ns.size, ns.size)),
+    'dm3': ('ccd', lambda d, i, ns: _write(write_dm3, os.path.join(d, 'image_%04d.dm3'%i), ns.size, ns.size)),
+    'tiff': ('ccd', lambda d, i, ns: _write(write_tiff, os.path.join(d, 'image_%04d.tif'%i), ns.size, ns.size)),
+    'ddd': ('ddd', lambda d, i, ns: write_ddd(os.path.join(d, 'ddd_%04d'%i), ns.size, ns.size, ns.frames)),
+    'serialem': ('serialem', lambda d, i, ns: _write(write_serialem, os.path.join(d, 'tilt_%04d.st'%i), ns.size, ns.size, ns.tilts)),
+}
+
+def _write(func, filename, *args):
+    func(filename, *args)
+    return filename
+
+def generate(kind, dirname, ns):
+    """Write ns.count items of a dataset; returns the names to upload."""
+    handler, func = datasets[kind]
+    os.makedirs(dirname)
+    return [func(dirname, i, ns) for i in range(ns.count)]
+
+##### Measurement #####
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values)-1) * p / 100.0
+    lo, hi = int(k), min(int(k)+1, len(values)-1)
+    return values[lo] + (values[hi]-values[lo]) * (k-lo)
+
+def peak_rss():
+    # ru_maxrss is in KB on Linux and bytes on OS X.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss * 1024
+
+def _timed(dbt):
+    t = time.time()
+    rec = dbt.upload()
+    elapsed = time.time() - t
+    # Bytes sent: the digests computed while uploading, or the file size.
+    size = sum(i.size for i in dbt.digests.values()) or os.path.getsize(dbt.name)
+    return elapsed, size, rec
+
+def run(kind, names, ns):
+    """Upload names through the dataset's handler; returns the metrics."""
+    handler, _ = datasets[kind]
+    engine = emdash.engine.TransferEngine(workers=ns.jobs)
+    cpu = os.times()
+    t = time.time()
+    jobs = []
+    for name in names:
+        dbt = emdash.handlers.get_handler(handler).new(name=name, data={'_target':ns.target})
+        jobs.append(engine.submit(_timed, dbt, name=name))
+    engine.wait(jobs)
+    wall = time.time() - t
+    cpu_end = os.times()
+    engine.shutdown(wait=True)
+
+    failed = [job for job in jobs if job.exception()]
+    for job in failed:
+        print "Failed:", job.name, job.exception()
+    done = [job.result() for job in jobs if not job.exception()]
+    latencies = [i[0] for i in done]
+    size = sum(i[1] for i in done)
+    return {
+        'dataset': kind,
+        'handler': handler,
+        'files': len(done),
+        'failed': len(failed),
+        'bytes': size,
+        'seconds': wall,
+        'mb_s': size / (1024*1024.0) / wall,
+        'files_s': len(done) / wall,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'cpu_user': cpu_end[0] - cpu[0],
+        'cpu_system': cpu_end[1] - cpu[1],
+        'cpu_percent': 100.0 * ((cpu_end[0]-cpu[0]) + (cpu_end[1]-cpu[1])) / wall,
+        'peak_rss': peak_rss()
+    }
+
+##### Results #####
+
+# Options that must match for two results to be compared.
+compare_keys = ['size', 'count', 'frames', 'tilts', 'jobs', 'compress', 'resume', 'parallel', 'segmentsize', 'readahead', 'readahead_size', 'server_rate', 'server_latency']
+
+def load(filename):
+    ret = []
+    if not os.path.exists(filename):
+        return ret
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                ret.append(json.loads(line))
+    return ret
+
+def save(filename, results):
+    with open(filename, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+def previous(history, result):
+    """The most recent earlier result for the same dataset and options."""
+    for item in reversed(history):
+        if item.get('dataset') != result['dataset']:
+            continue
+        if all(item.get('options', {}).get(k) == result['options'].get(k) for k in compare_keys):
+            return item
+
+def report(result, prev=None):
+    line = "%-9s %4d files %9.1f MB %8.2f MB/s %7.2f files/s  p50 %6.3f s  p99 %6.3f s  cpu %5.1f%%  rss %6.1f MB"%(
+        result['dataset'], result['files'], result['bytes']/(1024*1024.0), result['mb_s'], result['files_s'],
+        result['p50'] or 0, result['p99'] or 0, result['cpu_percent'], result['peak_rss']/(1024*1024.0))
+    if result['failed']:
+        line += "  (%s failed)"%result['failed']
+    print line
+    if prev and prev.get('mb_s'):
+        print "%-9s vs %s (emdash %s): %+.1f%% MB/s, %+.1f%% p99"%(
+            '', prev.get('date'), prev.get('version'),
+            100.0 * (result['mb_s'] - prev['mb_s']) / prev['mb_s'],
+            100.0 * ((result['p99'] or 0) - (prev.get('p99') or 0)) / (prev.get('p99') or 1))
+
+##### Benchmark #####
+
+class BenchmarkConfig(emdash.config.Config):
+    # Separate settings, so a benchmark login doesn't replace the user's session.
+    applicationname = "EMDashBenchmark"
+    def add_options(self, parser):
+        parser.add_argument("--datasets", help="Datasets to run: %s"%", ".join(sorted(datasets)), default="mrc,dm3,tiff,ddd,serialem")
+        parser.add_argument("--count", type=int, help="Files per dataset", default=8)
+        parser.add_argument("--size", type=int, help="Image width and height in pixels", default=2048)
+        parser.add_argument("--frames", type=int, help="Raw frames per DDD exposure", default=4)
+        parser.add_argument("--tilts", type=int, help="Sections per SerialEM stack", default=8)
+        parser.add_argument("--target", help="Target record", default="0")
+        parser.add_argument("--jobs", "-j", type=int, help="Number of files to upload at once", default=1)
+        parser.add_argument("--resume", action="store_true", help="Use resumable uploads", default=False)
+        parser.add_argument("--parallel", type=int, help="Upload large files as segments over this many connections", default=1)
+        parser.add_argument("--segmentsize", type=int, help="Segment size in MB for parallel uploads", default=256)
+        parser.add_argument("--compress", help="Compress uploads on the fly: gzip, zstd, lz4 (requires server support for Content-Encoding on uploads)")
+        parser.add_argument("--readahead", type=int, help="Read-ahead buffers per upload; 0 disables (default: 4 on network filesystems)")
+        parser.add_argument("--readahead_size", type=int, help="Read-ahead buffer size in MB", default=4)
+        parser.add_argument("--external", action="store_true", help="Use the server at --host instead of starting a mock server", default=False)
+        parser.add_argument("--server_rate", help="Mock server bandwidth cap, e.g. 100M")
+        parser.add_argument("--server_latency", type=float, help="Mock server latency per request (seconds)", default=0)
+        parser.add_argument("--server_error_rate", type=float, help="Mock server error rate", default=0)
+        parser.add_argument("--results", help="Append results to this file", default="emdash_benchmark.jsonl")
+        parser.add_argument("--workdir", help="Directory for the synthetic data (default: temporary)")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic data", default=False)
+
+def start_server(ns, datadir):
+    """Start the mock server in a subprocess, so its CPU isn't counted; returns (process, url)."""
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    args = [sys.executable, '-m', 'emdash.mockserver', '--port', str(port), '--datadir', datadir]
+    if ns.server_rate:
+        args += ['--rate', ns.server_rate]
+    if ns.server_latency:
+        args += ['--latency', str(ns.server_latency)]
+    if ns.server_error_rate:
+        args += ['--error_rate', str(ns.server_error_rate)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    proc = subprocess.Popen(args, env=env, stdout=open(os.devnull, 'w'))
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except socket.error:
+            if proc.poll() is not None:
+                raise Exception, "Mock server exited with status %s"%proc.returncode
+            time.sleep(0.1)
+    return proc, 'http://127.0.0.1:%s'%port
+
+def main():
+    ns = emdash.config.setconfig(BenchmarkConfig)
+    workdir = ns.workdir or tempfile.mkdtemp(prefix='emdash-benchmark-')
+    datadir = os.path.join(workdir, 'server')
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    # Keep uploads out of the user's ledger, and time the transfers, not dedup.
+    emdash.config.set('ledger', os.path.join(workdir, 'uploads.db'))
+    emdash.config.set('nodedup', True)
+    proc = None
+    try:
+        if not ns.external:
+            proc, url = start_server(ns, datadir)
+            emdash.config.set('host', url)
+            emdash.config.set('username', 'benchmark')
+            emdash.config.set('password', 'benchmark')
+        emdash.config.login()
+
+        options = dict((k, getattr(ns, k, None)) for k in compare_keys)
+        history = load(ns.results)
+        results = []
+        for kind in [i.strip() for i in ns.datasets.split(',') if i.strip()]:
+            if kind not in datasets:
+                raise ValueError, "Unknown dataset: %s"%kind
+            print "Generating %s x %s..."%(ns.count, kind)
+            names = generate(kind, os.path.join(workdir, kind), ns)
+            results.append(run(kind, names, ns))
+
+        date = datetime.datetime.now().replace(microsecond=0).isoformat()
+        print "\n--- emdash %s benchmark, %s ---"%(emdash.__version__, date)
+        for result in results:
+            result.update({
+                'date': date,
+                'version': emdash.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'host': 'mock' if proc else emdash.config.get('host'),
+                'options': options
+            })
+            report(result, previous(history, result))
+        save(ns.results, results)
+        print "Results appended to %s"%ns.results
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if not ns.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,10 @@ def setconfig(cls=None):
     """Install the Config and parse."""
     global config
     config = (cls or Config)()
-    return config.parse()
+    ns = config.parse()
+    import emdash.bandwidth
+    emdash.bandwidth.configure()
+    return ns
 
 def get(key, default=None):
     return config.get(key, default)
@@ -52,6 +55,7 @@ class Config(object):
         self.defaults = self.set_defaults()
         self.config = {}
         self.store = self.open()
+        self._db = {}
     
     def set_defaults(self):
         import emdash
@@ -60,6 +64,16 @@ class Config(object):
         defaults['starclosed'] = u"\u2605"
         defaults['staropen'] = u"\u2606"
         defaults['sleeptime'] = 5
+        defaults['jobs'] = 1
+        defaults['parallel'] = 1
+        defaults['segmentsize'] = 256
+        defaults['segments'] = 1
+        defaults['readahead_size'] = 4
+        defaults['timeout'] = 120
+        defaults['digest_cache'] = os.path.join(os.path.expanduser('~'), '.emdash', 'digests.json')
+        defaults['ledger'] = os.path.join(os.path.expanduser('~'), '.emdash', 'uploads.db')
+        defaults['sidecar'] = False
+        defaults['dedup_server'] = False
         defaults['USER_AGENT'] = "emdash %s"%emdash.__version__
         return defaults
         
@@ -70,6 +84,11 @@ class Config(object):
         self.defaults['host'] = "http://localhost:8080"
         parser.add_argument('--username', '-U', action="store")
         parser.add_argument('--password', '-P', action="store")
+        parser.add_argument('--limit_upload', help="Upload bandwidth limit, bytes/sec; K, M or G suffix (e.g. 10M)")
+        parser.add_argument('--limit_download', help="Download bandwidth limit, bytes/sec; K, M or G suffix")
+        parser.add_argument('--schedule_upload', help="Time-of-day upload limits, e.g. 08:00-18:00=10M,18:00-08:00=0")
+        parser.add_argument('--schedule_download', help="Time-of-day download limits")
+        parser.add_argument('--timeout', type=float, help="Network timeout in seconds; a connection that stalls this long fails (default: 120)")
         self.add_options(parser)
         return parser
         
@@ -135,13 +154,21 @@ class Config(object):
         
     def db(self, ctxid=None):
         import jsonrpc.proxy
+        import emdash.transport
+        ctxid = ctxid or self.get('ctxid')
+        # Reuse the proxy for this host and ctxid.
+        key = (self.get('host'), ctxid)
+        if key in self._db:
+            return self._db[key]
         db = jsonrpc.proxy.JSONRPCProxy(host=self.get('host'))      
+        # Send requests over the shared keep-alive connection pool.
+        db._opener.add_handler(emdash.transport.KeepAliveHandler())
         # Awful hack: Set the User-Agent.
         # db._opener.addheaders += [("User-Agent", self.get('USER_AGENT'))]
-        ctxid = ctxid or self.get('ctxid')
         if ctxid:
             # Awful hack: set the ctxid.
             db._opener.addheaders += [("Cookie", "ctxid=%s"%ctxid)]
+        self._db[key] = db
         return db
     
 def main():
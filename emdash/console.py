@@ -1,14 +1,22 @@
+import Queue
+import functools
 import glob
 import optparse
 import os
 import re
 import sys
+import threading
 import time
 
 # emdash imports
 import emdash.config
+import emdash.discover
+import emdash.engine
 import emdash.handlers
 import emdash.emhandlers
+import emdash.log
+import emdash.retry
+import emdash.transport
 
 class DownloadConfig(emdash.config.Config):
     applicationname = "EMDash"
@@ -17,6 +25,9 @@ class DownloadConfig(emdash.config.Config):
         parser.add_argument("--overwrite", action="store_true", help="Overwrite existing files (default is to skip)", default=False)
         parser.add_argument("--rename", action="store_true", help="Rename files to the BDO name (e.g. bdo.201202020000.dm3)", default=False)
         parser.add_argument("--nogzip", action="store_true", help="Do not decompress files", default=False)
+        parser.add_argument("--jobs", "-j", type=int, help="Number of files to download at once", default=1)
+        parser.add_argument("--retries", type=int, help="Attempts per file after the first failure", default=3)
+        parser.add_argument("--segments", type=int, help="Download large files as this many concurrent ranges", default=1)
         parser.add_argument('names', metavar='names', nargs='+', help='Record names')
 
 
@@ -26,9 +37,65 @@ class UploadConfig(emdash.config.Config):
         parser.add_argument("--handler", help="Handler; examples: ccd, ddd, stack")
         parser.add_argument("--rectype", help="Set rectype on handler.")
         parser.add_argument("--param", help="Set param on handler.")
+        parser.add_argument("--resume", action="store_true", help="Use resumable uploads for large files (requires server support)", default=False)
+        parser.add_argument("--parallel", type=int, help="Upload large files as segments over this many connections (requires server support)", default=1)
+        parser.add_argument("--segmentsize", type=int, help="Segment size in MB for parallel uploads", default=256)
+        parser.add_argument("--compress", help="Compress uploads on the fly: gzip, zstd, lz4 (requires server support for Content-Encoding on uploads)")
+        parser.add_argument("--jobs", "-j", type=int, help="Number of files to upload at once", default=1)
+        parser.add_argument("--readahead", type=int, help="Read-ahead buffers per upload; 0 disables (default: 4 on network filesystems)")
+        parser.add_argument("--readahead_size", type=int, help="Read-ahead buffer size in MB", default=4)
+        parser.add_argument("--sidecar", action="store_true", help="Also write a <file>.json sidecar for each uploaded file", default=False)
+        parser.add_argument("--ledger", help="Upload ledger database (default: ~/.emdash/uploads.db)")
+        parser.add_argument("--nodedup", action="store_true", help="Upload files even if the same content was uploaded before", default=False)
+        parser.add_argument("--dedup_server", action="store_true", help="Before uploading, ask the server for a file with the same md5", default=False)
         parser.add_argument('target', metavar='target', nargs=1, help='Target record')
         parser.add_argument('names', metavar='names', nargs='+', help='Record names')
 
+class DownloadProgress(object):
+    """Shared progress summary for concurrent downloads."""
+    def __init__(self, bdos):
+        self.sizes = dict((bdo.get('name'), int(bdo.get('filesize') or 0)) for bdo in bdos)
+        self.total = sum(self.sizes.values())
+        self.count = len(bdos)
+        self.active = {}
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def progress(self, batch):
+        # Progress listener: {name: {'progress':...}}
+        with self.lock:
+            for name, d in batch.items():
+                if name in self.sizes:
+                    self.active[name] = d.get('progress', 0) * self.sizes[name]
+        self.show()
+
+    def finish(self, name, ok=True):
+        with self.lock:
+            self.active.pop(name, None)
+            if ok:
+                self.done += 1
+                self.bytes += self.sizes.get(name, 0)
+            else:
+                self.failed += 1
+        emdash.log.progress_clear(name)
+        self.show()
+
+    def summary(self):
+        with self.lock:
+            count = self.bytes + sum(self.active.values())
+            line = "%s/%s files, %s failed, %0.1f / %0.1f MB, %0.2f MB/s"%(
+                self.done, self.count, self.failed, count/(1024*1024.0), self.total/(1024*1024.0),
+                count/(1024*1024.0)/max(time.time()-self.start, 0.001))
+        return line
+
+    def show(self):
+        if sys.stdout.isatty():
+            sys.stdout.write("\r[%s] "%self.summary())
+            sys.stdout.flush()
+
 def download():
     # Parse arguments
     ns = emdash.config.setconfig(DownloadConfig)
@@ -37,25 +104,94 @@ def download():
 
     # Login
     emdash.config.login()
-    ctxid = emdash.config.get('ctxid')
-    host = emdash.config.get('host')
     
-    # Download
-    bdos = []
-    for name in names:
-        if recurse != 0:
-            recs = [name]
-            recs += emdash.config.db().rel.children(name, recurse=recurse)
-        else:
-            recs = [name]
-        print "Found recs:", len(recs)
-        bdos = emdash.config.db().binary.find(record=recs, count=0)
-        print "Found bdos:", len(bdos)
+    # Find all the binaries first.
+    manifest = emdash.discover.discover(names, recurse=recurse)
+    print "Found %s"%manifest.summary()
+    bdos = manifest.bdos
+    if ns.rename:
+        for bdo in bdos:
+            bdo['_rename'] = True
+
+    # Fetch concurrently; keep an idle connection for each worker and segment.
+    emdash.transport.default_pool.maxidle = max(emdash.transport.default_pool.maxidle, ns.jobs*ns.segments)
+    return fetch(bdos, jobs=ns.jobs, retries=ns.retries)
+
+def fetch(bdos, jobs=1, retries=3, finished=None):
+    """Download bdos on jobs workers, retrying failures with backoff.
 
+    finished(bdo, handler, result) is called in this thread after each
+    successful download; result is None if an existing file was skipped.
+    Returns a list of (bdo, kind, exception) for the files that failed.
+
+    Binaries that would be saved to the same local file (e.g. the same
+    filename in different records) are renamed for the binary; see
+    FileHandler.download_filename.
+    """
+    seen = set()
     for bdo in bdos:
-        uri = '%s/download/%s/%s?ctxid=%s'%(host, bdo.get('name'), bdo.get('filename'), ctxid)
+        filename = os.path.abspath(emdash.handlers.FileHandler(data=bdo).download_filename())
+        if filename in seen:
+            bdo['_rename'] = True
+            filename = os.path.abspath(emdash.handlers.FileHandler(data=bdo).download_filename())
+            print "%s: %s is used by another binary; saving as %s"%(bdo.get('name'), bdo.get('filename'), os.path.basename(filename))
+        seen.add(filename)
+
+    engine = emdash.engine.TransferEngine(workers=jobs)
+    progress = DownloadProgress(bdos)
+    emdash.log.add_progress_listener(progress.progress)
+    policy = emdash.retry.RetryPolicy(attempts={emdash.retry.TRANSIENT:retries, emdash.retry.SERVER:retries})
+    scheduler = emdash.retry.RetryScheduler()
+    results = Queue.Queue()
+
+    def submit(bdo):
         dbt = emdash.handlers.FileHandler(name=bdo.get('name'), data=bdo)
-        dbt.download()
+        job = engine.submit(dbt.download, name=bdo.get('name'))
+        job.add_done_callback(lambda job: results.put((bdo, dbt, job)))
+
+    for bdo in bdos:
+        submit(bdo)
+
+    # A failed file is resubmitted after a backoff delay, until its retry
+    # budget runs out; workers don't wait out the delay.
+    attempts = {}
+    failed = []
+    skipped = 0
+    remaining = len(bdos)
+    while remaining:
+        bdo, dbt, job = results.get()
+        name = bdo.get('name')
+        e = job.exception()
+        if e:
+            attempts[name] = attempts.get(name, 0) + 1
+            kind, delay = policy.retry(e, attempts[name])
+            if delay is not None:
+                print "\nRetrying %s in %0.1f s (%s error): %s"%(bdo.get('filename'), delay, kind, e)
+                scheduler.schedule(name, delay, functools.partial(submit, bdo), attempt=attempts[name], error=unicode(e))
+                continue
+            failed.append((bdo, kind, e))
+        else:
+            if job.result() is None:
+                skipped += 1
+            if finished:
+                finished(bdo, dbt, job.result())
+        progress.finish(name, ok=not e)
+        remaining -= 1
+    engine.shutdown(wait=True)
+    emdash.log.remove_progress_listener(progress.progress)
+
+    # Save the digests of the new files now; a long-running sync may never exit cleanly.
+    try:
+        emdash.transport.digest_cache().save()
+    except EnvironmentError, e:
+        emdash.log.error("Couldn't save the digest cache: %s"%e, exception=e)
+
+    print "\n--- Download complete: %s ---"%progress.summary()
+    if skipped:
+        print "Skipped %s existing files"%skipped
+    for bdo, kind, e in failed:
+        print "Failed: %s %s (%s error, %s attempts): %s"%(bdo.get('name'), bdo.get('filename'), kind, attempts.get(bdo.get('name')), e)
+    return failed
         
 def upload():
     # Parse arguments
@@ -68,6 +204,8 @@ def upload():
     host = emdash.config.get('host')
     
     # Upload
+    engine = emdash.engine.TransferEngine(workers=ns.jobs)
+    jobs = []
     for name in names:
         dbt = emdash.handlers.get_handler(ns.handler)
         dbt.target = ns.target[0]
@@ -76,4 +214,9 @@ def upload():
             dbt.rectype = ns.rectype
         if ns.param:
             dbt.param = ns.param
-        dbt.upload()
+        jobs.append(engine.submit(dbt.upload, name=name))
+
+    failed = [job for job in engine.wait(jobs) if job.exception()]
+    engine.shutdown(wait=True)
+    for job in failed:
+        print "Failed:", job.name, job.exception()
@@ -0,0 +1,82 @@
+import time
+
+import emdash.config
+
+##### Record and binary discovery #####
+
+class Manifest(object):
+    """Records and binaries found under a set of names, without duplicates."""
+    def __init__(self, names=None):
+        self.names = list(names or [])
+        self.records = []
+        self.bdos = []
+        self.calls = 0
+        self.elapsed = 0.0
+        self._records = set()
+        self._bdos = set()
+
+    def add_records(self, names):
+        for name in names:
+            name = unicode(name)
+            if name not in self._records:
+                self._records.add(name)
+                self.records.append(name)
+
+    def add_bdos(self, bdos):
+        for bdo in bdos:
+            if bdo.get('name') not in self._bdos:
+                self._bdos.add(bdo.get('name'))
+                self.bdos.append(bdo)
+
+    @property
+    def size(self):
+        """Total bytes of all binaries."""
+        return sum(int(bdo.get('filesize') or 0) for bdo in self.bdos)
+
+    def summary(self):
+        return "%s names, %s records, %s binaries, %0.1f MB (%s requests, %0.1f s)"%(
+            len(self.names), len(self.records), len(self.bdos), self.size/(1024*1024.0), self.calls, self.elapsed)
+
+def discover(names, recurse=-1, db=None, batch=500, count=1000):
+    """Find the binaries in names and their children; returns a Manifest."""
+    db = db or emdash.config.db()
+    manifest = Manifest(names)
+    t = time.time()
+    expand(db, manifest, recurse)
+    find_binaries(db, manifest, manifest.records, batch=batch, count=count)
+    manifest.elapsed = time.time() - t
+    return manifest
+
+def expand(db, manifest, recurse=-1):
+    """Add manifest.names and their children, with one rel.children request."""
+    manifest.add_records(manifest.names)
+    if recurse == 0 or not manifest.names:
+        return
+    children = db.rel.children(list(manifest.names), recurse=recurse)
+    manifest.calls += 1
+    # Lists of names return {name: [children]}; a single name may return a list.
+    if isinstance(children, dict):
+        children = [i for name in manifest.names for i in children.get(name) or []]
+    manifest.add_records(children)
+
+def find_binaries(db, manifest, records, batch=500, count=1000):
+    """Add the binaries attached to records.
+
+    binary.find is called for batches of at most batch records, with a
+    limit of count results. A batch that hits the limit may be
+    incomplete, so it is split in half and asked again.
+    """
+    pages = [records[i:i+batch] for i in range(0, len(records), batch)]
+    while pages:
+        recs = pages.pop(0)
+        bdos = db.binary.find(record=recs, count=count)
+        manifest.calls += 1
+        if count and len(bdos) >= count:
+            if len(recs) > 1:
+                half = len(recs) // 2
+                pages[0:0] = [recs[:half], recs[half:]]
+                continue
+            # One record with more binaries than the limit.
+            bdos = db.binary.find(record=recs, count=0)
+            manifest.calls += 1
+        manifest.add_bdos(bdos)
@@ -16,6 +16,7 @@ from PyQt4 import QtGui, QtCore, Qt
 
 # emdash imports
 import emdash.config
+import emdash.discover
 import emdash.emmodels
 import emdash.emwizard
 import emdash.emthreads
@@ -76,18 +77,9 @@ class BaseDownload(emdash.upload.BaseTransport):
 
     def _set_download(self, name):
         # Download
-        recurse = -1
-        bdos = []
-        if recurse != 0:
-            recs = [name]
-            recs += emdash.config.db().rel.children(name, recurse=recurse)
-        else:
-            recs = [name]
-        self.log("Found recs: %s"%len(recs))
-
-        bdos = emdash.config.db().binary.find(record=recs, count=0)
-        self.log("Found bdos: %s"%len(bdos))
-        for bdo in bdos:
+        manifest = emdash.discover.discover([name], recurse=-1)
+        self.log("Found %s"%manifest.summary())
+        for bdo in manifest.bdos:
             self.newfile(bdo.get('name'), bdo)
 
     @QtCore.pyqtSlot(unicode, object)
@@ -27,6 +27,7 @@ except ImportError:
 # EMDash imports
 import emdash.config
 import emdash.log
+import emdash.retry
 import emdash.transport
 from emdash.handlers import Handler, FileHandler
 
@@ -219,7 +220,7 @@ class EMDataReader(object):
     def emdata_header(self):
         """Get header information from EMAN2."""
         if not EMAN2:
-            return
+            return {}
                 
         # EMAN2 only works with str filenames; no unicode.
         img = EMAN2.EMData()
@@ -334,6 +335,10 @@ class DDDHandler(FileHandler):
         if os.path.basename(item) == "info.txt":
             return item
 
+    def uploaded_paths(self, item):
+        # Done once info.txt and the raw frames are uploaded.
+        return [item, os.path.join(os.path.dirname(item), "raw.hdf")]
+
     def display_name(self):
         # Display just the directory name.
         return os.path.basename(os.path.dirname(self.name))
@@ -342,8 +347,8 @@ class DDDHandler(FileHandler):
         self.log("\n--- Starting upload: %s ---"%self.name)
         self.log("Checking for previously uploaded files...")
         
-        # Check JSON. First, look if info.txt is uploaded. Then, check raw frames.
-        check = self.sidecar_read(self.name)
+        # Check the upload ledger. First, look if info.txt is uploaded. Then, check raw frames.
+        check = self.uploaded_read(self.name)
         if check.get('name'):
             self.log("Already exists in database -- check %s"%check.get('name'))
             # Try to upload raw frames that weren't already uploaded.
@@ -400,12 +405,20 @@ class DDDHandler(FileHandler):
         if rec.get('name') is None:
             raise Exception, "Error uploading! Did not get a record ID!"
 
-        # Close handles and write sidecar files.
-        for f in files:
-            f.close()
-            self.sidecar_write(f.name, {"name":rec.get('name')})
-
-        # Upload the raw HDF to the newly created record.
+        # Close handles and record the uploads. The record exists now; if
+        # it isn't in the ledger, a retry would create another one.
+        try:
+            for f in files:
+                f.close()
+                check = {"name":rec.get('name')}
+                check.update(self.checksums(f.name))
+                self.uploaded_write(f.name, check)
+        except Exception, e:
+            raise emdash.retry.PermanentError, "Uploaded to %s, but could not record the upload: %s"%(rec.get('name'), e)
+
+        # Upload the raw HDF to the newly created record. Errors go to the
+        # item's retry policy; a retry finds info.txt in the ledger and
+        # only sends the raw HDF, to this record.
         self.upload_raw_hdf(rec.get('name'))
 
         # Return the updated (or new) record..
@@ -416,18 +429,22 @@ class DDDHandler(FileHandler):
         name_prefix = os.path.basename(os.path.dirname(self.name))+'_'
         
         # Check to see if a raw HDF was already uploaded.
-        # The raw HDF file itself may have been removed, and just left the raw.json file.
-        check = self.sidecar_read(raw_filename)
+        # The raw HDF file itself may have been removed, and just left its ledger entry.
+        check = self.uploaded_read(raw_filename)
         if check.get('name'):
             self.log("Raw HDF exists in database -- check %s"%check.get('name'))
             return check
         
-        # Create raw HDF. 
-        if os.path.exists(raw_filename):
-            self.log("Removing existing raw HDF.")
-            os.unlink(raw_filename)
-        
-        self.create_raw_hdf(raw_filename)
+        # Create raw HDF. An interrupted resumable upload leaves its
+        # checkpoint next to the raw HDF; keep that file so --resume can
+        # continue where it stopped.
+        if os.path.exists(raw_filename) and os.path.exists(raw_filename + ".upload.json"):
+            self.log("Resuming upload of existing raw HDF.")
+        else:
+            if os.path.exists(raw_filename):
+                self.log("Removing existing raw HDF.")
+                os.unlink(raw_filename)
+            self.create_raw_hdf(raw_filename)
         if not os.path.exists(raw_filename):
             self.log("No raw frames to upload?")
             return
@@ -441,12 +458,16 @@ class DDDHandler(FileHandler):
             'ctxid': emdash.config.get('ctxid'),
             'ddd_binary_raw': raw_file
         }
-        self._upload_put('/record/%s/edit/'%(target), raw_qs)
-        # Close the file
-        raw_file.close()
-        self.sidecar_write(raw_filename, {"name":target})
+        try:
+            self._upload_put('/record/%s/edit/'%(target), raw_qs)
+        finally:
+            # Close the file
+            raw_file.close()
+        check = {"name":target}
+        check.update(self.checksums(raw_filename))
+        self.uploaded_write(raw_filename, check)
         
-        # Remove temporary raw HDF file
+        # Remove temporary raw HDF file, now that it's uploaded
         if os.path.exists(raw_filename):
             os.unlink(raw_filename)
 
@@ -456,6 +477,9 @@ class DDDHandler(FileHandler):
         files = self.find('RawImage')
         if not files:
             return
+        if not EMAN2:
+            self.log("EMAN2 is not available; cannot create raw HDF")
+            return
         self.log("Creating raw HDF with %s frames: %s"%(len(files), outfile))
         outfile = str(outfile)
         # Sort the raw frames
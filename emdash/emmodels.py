@@ -120,6 +120,12 @@ class QueueModel(QtCore.QAbstractItemModel):
         """Update the status dict for a file"""
         self._updatestatus(name, data)
 
+    @QtCore.pyqtSlot(object)
+    def file_progress(self, batch):
+        """Update progress for a batch of files: {name: {'progress':...}}"""
+        for name, d in batch.items():
+            self._updatestatus(name, {'_status': d.get('progress')})
+
     @QtCore.pyqtSlot(unicode, object)
     def file_success(self, name, data):
         """A file has been successfully uploaded into the db"""
@@ -128,8 +134,8 @@ class QueueModel(QtCore.QAbstractItemModel):
 
     @QtCore.pyqtSlot(unicode, str)
     def file_failure(self, name, e):
-        """There was an error uploading file"""
-        self._updatestatus(name, {"_error": e, "_status": "Retry: %s"%e})
+        """The upload failed and won't be retried"""
+        self._updatestatus(name, {"_error": e, "_status": "Failed: %s"%e})
 
     def _updatestatus(self, name, d):
         # Access by filename
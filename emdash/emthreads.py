@@ -1,6 +1,7 @@
 import Queue
 import collections
 import datetime
+import functools
 import json
 import operator
 import os
@@ -9,7 +10,9 @@ import time
 from PyQt4 import QtCore
 
 import emdash.config
+import emdash.engine
 import emdash.log
+import emdash.retry
 import emdash.handlers
 
 class DBThread(QtCore.QThread):
@@ -104,8 +107,22 @@ class UploadThread(QtCore.QThread):
     def __init__(self, parent=None, queue=None):
         self.queue = queue
         self.handler = emdash.handlers.get_handler(emdash.config.get("handler"))
+        # Transfers run on the engine; this thread hands them out.
+        # The small backlog leaves waiting items in our queue.
+        self.engine = emdash.engine.TransferEngine(workers=int(emdash.config.get('jobs') or 1), backlog=1)
+        # Failed items wait here, not on a worker, until their next attempt.
+        self.policy = emdash.retry.default_policy
+        self.retries = emdash.retry.RetryScheduler()
+        self.attempts = {}
+        # Set while watching a directory; see set_path.
+        self.watch = False
         QtCore.QThread.__init__(self, parent=parent)
 
+    @QtCore.pyqtSlot(unicode, bool, bool)
+    def set_path(self, path, existing=True, watch=True):
+        # A watch runs unattended, so errors that may clear up are never given up on.
+        self.watch = watch
+
     def run(self):        
         while True:
             self.action()
@@ -122,17 +139,54 @@ class UploadThread(QtCore.QThread):
 
         # Wait a small amount of time before proceeding..
         dbt.setwait(emdash.config.get('sleeptime'))
+        self.submit(name, data, dbt.upload)
 
-        try:
-            rec = dbt.upload()
-        except Exception, e:
-            emdash.log.error("UploadThread exception: %s"%e, exception=e)
+    def submit(self, name, data, func):
+        job = self.engine.submit(func, name=name)
+        job.add_done_callback(functools.partial(self.done, name, data))
+        self.queue.task_done()
+        return job
+
+    def done(self, name, data, job):
+        # Called from the engine's worker thread.
+        emdash.log.progress_clear(name)
+        e = job.exception()
+        if job.cancelled():
             self.signal_failure.emit(name, unicode(e))
-            self.queue.put((name, data))
-            time.sleep(emdash.config.get('sleeptime'))
+        elif e:
+            emdash.log.error("%s exception: %s\n%s"%(self.__class__.__name__, e, job.traceback))
+            self.retry(name, data, e)
         else:
-            self.signal_success.emit(name, rec)
-        self.queue.task_done()
+            self.attempts.pop(name, None)
+            self.signal_success.emit(name, job.result())
+
+    def retry(self, name, data, e):
+        attempt = self.attempts.get(name, 0) + 1
+        kind, delay = self.policy.retry(e, attempt)
+        if delay is None and self.watch and kind in (emdash.retry.TRANSIENT, emdash.retry.SERVER):
+            # Out of attempts; keep trying at the maximum delay.
+            delay = self.policy.delay(attempt)
+        if delay is None:
+            self.attempts.pop(name, None)
+            self.signal_failure.emit(name, u"%s (%s error, %s attempts)"%(e, kind, attempt))
+            return
+        self.attempts[name] = attempt
+        when = self.retries.schedule(name, delay, functools.partial(self.requeue, name, data), attempt=attempt, error=unicode(e))
+        self.signal_status.emit(name, {
+            '_status': u"Retry %s in %d s: %s"%(attempt, delay, e),
+            '_error': unicode(e),
+            '_attempts': attempt,
+            '_retry_at': when
+        })
+
+    def requeue(self, name, data):
+        # Called from the retry timer; drop the item if the session ended.
+        if not self.engine.closed:
+            self.queue.put((name, data))
+
+    def pending_retries(self):
+        """{name: {'attempt':..., 'when':..., 'error':...}} for items waiting to retry."""
+        return self.retries.pending()
 
 class DownloadThread(UploadThread):
     signal_failure = QtCore.pyqtSignal(unicode, unicode)
@@ -142,11 +196,5 @@ class DownloadThread(UploadThread):
     def action(self):
         name, data = self.queue.get()    
         dbt = emdash.handlers.FileHandler(name=name, data=data)
-        try:
-            dbt.download()
-        except Exception, e:
-            emdash.log.error("DownloadThread exception: %s"%e, exception=e)
-            self.signal_failure.emit(filename, unicode(e))
-            self.queue.put((name, data))
-        self.queue.task_done()
+        self.submit(name, data, dbt.download)
         
\ No newline at end of file
@@ -0,0 +1,212 @@
+import Queue
+import threading
+import time
+import traceback
+
+import emdash.log
+
+##### Transfer engine #####
+
+class Cancelled(Exception):
+    pass
+
+# The job running in the current worker thread, for cancellation checks.
+_local = threading.local()
+
+def current():
+    """Return the Job running in this thread, or None."""
+    return getattr(_local, 'job', None)
+
+def check_cancelled():
+    """Raise Cancelled if the job running in this thread was cancelled.
+
+    Transfer loops call this between chunks, so a running transfer stops
+    at the next chunk boundary.
+    """
+    job = current()
+    if job and job._cancel:
+        raise Cancelled, "Transfer cancelled: %s"%job.name
+
+def adopt(job):
+    """Run the rest of this thread on behalf of job, so check_cancelled sees it.
+
+    For threads a transfer starts for itself, e.g. one per segment; call
+    it first thing in the thread, with the Job from current().
+    """
+    _local.job = job
+
+class Job(object):
+    """A submitted transfer: a callable, and a future for its result."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, func, args=None, kwargs=None, name=None):
+        self.func = func
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.name = name
+        self.state = self.PENDING
+        self._cancel = False
+        self._result = None
+        self._exception = None
+        self.traceback = None
+        self._callbacks = []
+        self._cond = threading.Condition()
+
+    def cancel(self):
+        """Cancel the job. Pending jobs never start; running jobs stop at the next chunk."""
+        with self._cond:
+            if self.state in (self.DONE, self.CANCELLED):
+                return False
+            self._cancel = True
+            if self.state == self.RUNNING:
+                return True
+        self._finish(self.CANCELLED, exception=Cancelled("Transfer cancelled: %s"%self.name))
+        return True
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def running(self):
+        return self.state == self.RUNNING
+
+    def done(self):
+        return self.state in (self.DONE, self.CANCELLED)
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self._exception
+
+    def wait(self, timeout=None):
+        with self._cond:
+            end = timeout and time.time() + timeout
+            while not self.done():
+                remaining = end and end - time.time()
+                if end and remaining <= 0:
+                    raise RuntimeError, "Timed out waiting for %s"%self.name
+                # Python 2 Condition.wait without a timeout can't be interrupted.
+                self._cond.wait(remaining or 1.0)
+
+    def add_done_callback(self, func):
+        """func(job) is called from the worker thread when the job finishes."""
+        with self._cond:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _run(self):
+        with self._cond:
+            if self.state != self.PENDING:
+                return
+            self.state = self.RUNNING
+        _local.job = self
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Cancelled, e:
+            self._finish(self.CANCELLED, exception=e)
+        except Exception, e:
+            self.traceback = traceback.format_exc()
+            self._finish(self.DONE, exception=e)
+        else:
+            self._finish(self.DONE, result=result)
+        finally:
+            _local.job = None
+
+    def _finish(self, state, result=None, exception=None):
+        with self._cond:
+            self.state = state
+            self._result = result
+            self._exception = exception
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, e:
+                emdash.log.error("Job callback exception: %s"%e, exception=e)
+
+class TransferEngine(object):
+    """Run transfer jobs on a bounded pool of worker threads.
+
+    At most `workers` jobs run at once. If backlog is set, submit()
+    blocks once that many jobs are waiting.
+    """
+    def __init__(self, workers=4, backlog=0):
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize=backlog)
+        self.jobs = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.closed = False
+
+    def submit(self, func, *args, **kwargs):
+        """Submit func(*args, **kwargs); returns a Job. The name keyword labels the job."""
+        name = kwargs.pop('name', None) or getattr(func, '__name__', None)
+        if self.closed:
+            raise RuntimeError, "Transfer engine is shut down"
+        job = Job(func, args, kwargs, name=name)
+        with self.lock:
+            self.jobs.add(job)
+            self._start()
+        job.add_done_callback(self._discard)
+        self.queue.put(job)
+        return job
+
+    def cancel_all(self):
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.cancel()
+
+    def wait(self, jobs=None):
+        """Wait for the given jobs (default: all submitted jobs) to finish."""
+        if jobs is None:
+            with self.lock:
+                jobs = list(self.jobs)
+        for job in jobs:
+            job.wait()
+        return jobs
+
+    def shutdown(self, cancel=False, wait=False):
+        self.closed = True
+        if cancel:
+            self.cancel_all()
+        # Wake idle workers; busy workers exit once the queue is drained.
+        for t in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def _start(self):
+        # Start worker threads on demand.
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job._run()
+            if self.closed and self.queue.empty():
+                return
+
+    def _discard(self, job):
+        with self.lock:
+            self.jobs.discard(job)
@@ -19,7 +19,10 @@ import dateutil
 import dateutil.tz
 
 import emdash.config
+import emdash.engine
+import emdash.ledger
 import emdash.log
+import emdash.retry
 import emdash.transport
 
 # Helper functions
@@ -72,6 +75,14 @@ def walk(path, exclude=None, include=None, seen=None):
 
     return sorted(ret, key=ctime)
 
+##### Upload compression policy #####
+
+# Uncompressed image formats that usually compress well.
+compress_exts = set(['.mrc', '.mrcs', '.st', '.ali', '.rec', '.dm3', '.dm4', '.hdf', '.h5', '.hdf5', '.spi', '.img', '.hed', '.raw'])
+
+# Never compress these; they are already compressed.
+compress_skip = set(['.gz', '.tgz', '.bz2', '.xz', '.zip', '.zst', '.lz4', '.jpg', '.jpeg', '.png', '.gif', '.mp4'])
+
 ##### Base Transport #####
 
 # Handler registration
@@ -87,6 +98,16 @@ class Handler(object):
 
     # Allowed extensions
     exts = []     
+
+    # Compress this handler's uploads when --compress is set
+    compress = True
+
+    # Check uploads against the server's md5, and re-send on mismatch
+    verify = True
+    verify_retries = 2
+
+    # Retries for short requests made during a transfer (see _retry)
+    retry_policy = emdash.retry.RetryPolicy(base=1, maxdelay=30, attempts={emdash.retry.TRANSIENT:3, emdash.retry.SERVER:3})
     
     # Handler registration
     _handlers = {}
@@ -99,6 +120,7 @@ class Handler(object):
         self.data = data or {}
         self.target = None
         self.wait = 0
+        self.digests = {}
         self.init(*args, **kwargs)
         
     def init(self, *args, **kwargs):
@@ -136,6 +158,86 @@ class Handler(object):
         kwargs['name'] = self.name
         emdash.log.msg(*args, **kwargs)
 
+    def progress(self, value, **kwargs):
+        emdash.log.progress(self.name, value, **kwargs)
+
+    def uploaded_read(self, filename):
+        """Return {'name':record, ...} if filename was uploaded before; otherwise {}."""
+        ledger = emdash.ledger.ledger()
+        entry = ledger.get(filename)
+        if entry:
+            if not ledger.current(entry, filename):
+                self.log("File changed since it was uploaded to %s; uploading again"%entry.get('record'))
+                return {}
+            if entry.get('record'):
+                return {'name':entry['record'], 'md5':entry['md5'], 'sha256':entry['sha256'], 'size':entry['bytes']}
+        # Files uploaded by older versions have a sidecar instead.
+        if not os.path.exists(filename+".json"):
+            return {}
+        check = self.sidecar_read(filename)
+        if check.get('name'):
+            emdash.ledger.ledger().add(filename, check['name'], md5=check.get('md5'), sha256=check.get('sha256'), size=check.get('size'))
+        return check
+
+    def uploaded_write(self, filename, data):
+        """Record an upload in the ledger, and in a sidecar if --sidecar is set."""
+        data = data or {}
+        emdash.ledger.ledger().add(filename, data.get('name'), md5=data.get('md5'), sha256=data.get('sha256'), size=data.get('size'))
+        if emdash.config.get('sidecar'):
+            self.sidecar_write(filename, data)
+
+    def dedup(self, filename):
+        """Return {'name':record, ...} if the content of filename was already uploaded.
+
+        Looks in the ledger for files with the same fingerprint, and
+        confirms a match with the full md5. With --dedup_server, also asks
+        the server for a binary with the same md5 and size. A matching
+        record is linked to this upload's target; see dedup_link.
+        """
+        if emdash.config.get('nodedup'):
+            return None
+        ledger = emdash.ledger.ledger()
+        fp = ledger.fingerprint(filename)
+        path = os.path.abspath(filename)
+        candidates = [i for i in ledger.find(fingerprint=fp['fingerprint']) if i['path'] != path and i['record'] and i['md5']]
+        if not candidates and not emdash.config.get('dedup_server'):
+            return None
+
+        fp = ledger.fingerprint(filename, full=True)
+        check = {'md5':fp['md5'], 'sha256':fp['sha256'], 'size':fp['size']}
+        for i in candidates:
+            if i['md5'] == fp['md5']:
+                self.log("Same content as %s"%i['path'])
+                self.dedup_link(i['record'])
+                return dict(check, name=i['record'])
+        if emdash.config.get('dedup_server'):
+            bdos = self._retry(emdash.config.db().binary.find, md5=fp['md5'], filesize=fp['size'], count=1)
+            if bdos and bdos[0].get('record'):
+                self.log("Same content as %s on the server"%bdos[0].get('name'))
+                self.dedup_link(bdos[0].get('record'))
+                return dict(check, name=bdos[0].get('record'))
+        return None
+
+    def dedup_link(self, record):
+        """Make record a child of the upload target, if it isn't already.
+
+        The matching record may have been uploaded to another target; the
+        link makes the file show up where it was uploaded this time.
+        """
+        target = self.target or self.data.get('_target')
+        if not target:
+            return
+        db = emdash.config.db()
+        rec = self._retry(db.record.get, record)
+        if unicode(target) in [unicode(i) for i in rec.get('parents') or []]:
+            return
+        self.log("Linking %s to %s"%(record, target))
+        self._retry(db.rel.pclink, target, record)
+
+    def uploaded_paths(self, item):
+        """Files that are in the ledger once item is completely uploaded."""
+        return [item]
+
     def sidecar_read(self, filename):
         """Read the JSON sidecar."""
         try:
@@ -148,47 +250,324 @@ class Handler(object):
         data = data or {}
         try:
             json.dump(data, file(filename+".json", "w"), indent=True)
-            # self.log("Wrote sidecar: %s.json"%filename)
-        except:
-            pass
+        except Exception, e:
+            emdash.log.error("Couldn't write sidecar %s.json: %s"%(filename, e), exception=e)
 
     ##### HTTP Transfers #####
 
     def _upload(self, path, data=None, opener_cls=None):
         t = time.time()
         opener_cls = opener_cls or emdash.transport.PostHandler
-        opener = opener_cls(log=self.log)
+        rec = self._upload_send(path, data, opener_cls)
+        
+        # kbsec = (filesize / (time.time() - t))/1024
+        # self.log("Uploaded to record %s @ %0.2f KB/sec"%(rec.get("name"), kbsec))
+        self.log("Upload completed in %5.2f s"%(time.time()-t))
+
+        # Compare the digests computed while sending with what the server
+        # stored; send any mismatched files again, to the new record.
+        # The record exists now, and retrying the whole upload would create
+        # another one, so failures from here on are permanent.
+        try:
+            bad = self._verify(rec, data)
+            attempt = 0
+            while bad:
+                if attempt >= self.verify_retries:
+                    raise emdash.retry.PermanentError, "Checksum mismatch after upload to %s: %s"%(rec.get('name'), ", ".join(bad))
+                attempt += 1
+                self.log("Checksum mismatch for %s; uploading again"%", ".join(bad))
+                data = self._resend_data(data, bad)
+                try:
+                    self._upload_send('/record/%s/edit/'%rec.get('name'), data, opener_cls)
+                    bad = self._verify(rec, data)
+                finally:
+                    for v in data.values():
+                        for i in (v if isinstance(v, list) else [v]):
+                            if hasattr(i, 'read'):
+                                i.close()
+        except (emdash.retry.PermanentError, emdash.engine.Cancelled):
+            raise
+        except Exception, e:
+            raise emdash.retry.PermanentError, "Uploaded to %s, but could not verify the upload: %s"%(rec.get('name'), e)
+        return rec
+
+    def _upload_send(self, path, data, opener_cls):
+        opener = opener_cls(log=self.log, progress=self.progress)
         resp = opener.open(path, data)
         status, reason, response = resp.status, resp.reason, resp.read()
         resp.close()
 
         if status not in range(200, 400):
-            raise httplib.HTTPException, "Error: %s"%(reason)
+            raise emdash.transport.HTTPError(status, reason, "Error: %s"%(reason))
 
+        self.digests.update(opener.digests)
         try:
             rec = json.loads(response)
         except Exception, e:
             emdash.log.error("Couldn't read JSON response: %s"%e, exception=e)
             rec = {}
-        
-        # kbsec = (filesize / (time.time() - t))/1024
-        # self.log("Uploaded to record %s @ %0.2f KB/sec"%(rec.get("name"), kbsec))
-        self.log("Upload completed in %5.2f s"%(time.time()-t))
         return rec
 
+    ##### Upload verification #####
+
+    def checksums(self, filename):
+        """Digests of filename, for verification and the upload ledger.
+
+        Usually computed while uploading. Segmented uploads read their
+        segments out of order, so the file is hashed afterwards instead;
+        the ledger caches the result by inode, size and mtime.
+        """
+        digest = self.digests.get(filename)
+        if digest:
+            return digest.hexdigests()
+        if os.path.isfile(filename):
+            fp = emdash.ledger.ledger().fingerprint(filename, full=True)
+            return {'md5':fp['md5'], 'sha256':fp['sha256'], 'size':fp['size']}
+        return {}
+
+    def _upload_files(self, data):
+        # Local filename -> uploaded filename, for each file in data.
+        ret = {}
+        for v in (data or {}).values():
+            for i in (v if isinstance(v, list) else [v]):
+                if hasattr(i, 'read') and hasattr(i, 'name'):
+                    ret[i.name] = os.path.basename(emdash.transport.filename_upload(i))
+        return ret
+
+    def _verify(self, rec, data):
+        """Return the local filenames whose upload doesn't match the server's binary."""
+        files = self._upload_files(data)
+        if not self.verify or not rec.get('name') or not files:
+            return []
+        try:
+            bdos = self._retry(emdash.config.db().binary.find, record=[rec.get('name')], count=0)
+        except Exception, e:
+            self.log("Could not verify upload: %s"%e)
+            return []
+
+        bad = []
+        for name, filename in files.items():
+            local = self.checksums(name)
+            if not local:
+                # No digest (e.g. segmented upload): compare sizes.
+                local = {'size': os.path.getsize(name)}
+            found = [i for i in bdos if i.get('filename') == filename]
+            if not found:
+                self.log("Could not find uploaded binary for %s"%filename)
+                continue
+            for bdo in found:
+                if local.get('md5') and bdo.get('md5'):
+                    if local['md5'] == bdo['md5']:
+                        break
+                elif bdo.get('filesize') is None or int(bdo['filesize']) == local['size']:
+                    break
+            else:
+                bad.append(name)
+        return bad
+
+    def _resend_data(self, data, names):
+        # Reopen the given files, keeping the params they were sent as.
+        ret = {'_format':'json', 'ctxid':emdash.config.get('ctxid')}
+        for k, v in data.items():
+            values = v if isinstance(v, list) else [v]
+            files = [
+                emdash.transport.UploadFile(i.name, "rb", name_upload=emdash.transport.filename_upload(i))
+                for i in values if hasattr(i, 'read') and i.name in names
+            ]
+            if files:
+                ret[k] = files if isinstance(v, list) else files[0]
+        return ret
+
     def _upload_post(self, *args, **kwargs):
         kwargs['opener_cls'] = emdash.transport.PostHandler
         return self._upload(*args, **kwargs)
         
-    def _upload_put(self, *args, **kwargs):
-        kwargs['opener_cls'] = emdash.transport.PutHandler
-        return self._upload(*args, **kwargs)
+    def compression(self, filename):
+        """Return the codec to use when uploading filename, or None."""
+        codec = emdash.config.get('compress')
+        if not codec or codec == 'none' or not self.compress:
+            return None
+        _, ext = os.path.splitext(filename)
+        ext = ext.lower()
+        if ext in compress_skip:
+            return None
+        if ext not in compress_exts and ext not in self.exts:
+            return None
+        if codec not in emdash.transport.codecs():
+            self.log("Compression %s not available; using gzip"%codec)
+            codec = 'gzip'
+        return codec
+
+    def _upload_put(self, path, data=None, **kwargs):
+        if int(emdash.config.get('parallel') or 1) > 1:
+            opener_cls = emdash.transport.SegmentedPutHandler
+        elif emdash.config.get('resume'):
+            opener_cls = emdash.transport.ResumablePutHandler
+        else:
+            opener_cls = emdash.transport.PutHandler
+
+        # Wrap files in a streaming compressor, if the policy allows.
+        data = dict(data or {})
+        compressed = []
+        for k, v in data.items():
+            codec = isinstance(v, file) and self.compression(v.name)
+            if codec:
+                self.log("Compressing %s with %s"%(os.path.basename(v.name), codec))
+                data[k] = emdash.transport.CompressedReader(v, codec=codec)
+                compressed.append(data[k])
+                # Compressed streams have no fixed length or offsets,
+                # so they always go over a single chunked PUT.
+                opener_cls = emdash.transport.PutHandler
+
+        kwargs['opener_cls'] = opener_cls
+        try:
+            rec = self._upload(path, data, **kwargs)
+        finally:
+            # Stop the compressor threads and close their files, even on failure.
+            for i in compressed:
+                i.close()
+        for i in compressed:
+            self.log("Compressed %s bytes to %s bytes"%(i.consumed, i.compressed))
+        return rec
 
-    def _download(self):
-        pass
+    def _download(self, path, filename, size=None, md5=None, gunzip=False, part=None):
+        """Download path to filename; returns the number of bytes received.
+
+        Data goes to part (default <filename>.part), and an interrupted download resumes
+        from the end of the .part file with a Range request. The .part file
+        is renamed to filename only after its size and md5 match. If gunzip
+        is set, gzip data is decompressed as it is written; size and md5
+        are still checked against the compressed data.
+
+        Segmented downloads go to <part>.segments instead (without the
+        .part extension), with their own checkpoint; a .part file only
+        ever holds a prefix of the file.
+        """
+        part = part or filename + ".part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if gunzip or (size is not None and offset > int(size)):
+            # A decompressed .part file can't be resumed.
+            offset = 0
+
+        # Large files can be fetched as several ranges at once; a .part
+        # left by an interrupted single-stream download is resumed instead.
+        segments = (part[:-len(".part")] if part.endswith(".part") else part) + ".segments"
+        opener = emdash.transport.SegmentedDownloadHandler(log=self.log, progress=self.progress)
+        if (os.path.exists(segments) or not offset) and not gunzip and opener.split(size):
+            try:
+                return self._download_segments(opener, path, segments, filename, size, md5)
+            except emdash.transport.RangeNotSupported:
+                self.log("Server does not support Range requests; downloading as one stream")
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%s-'%offset
+        resp = opener.open(path, headers=headers)
+        if resp.status == 416 and size is not None and offset == int(size):
+            # Already have all of it; just check it.
+            resp.read()
+            resp.close()
+        elif resp.status in (200, 206):
+            if resp.status == 200:
+                # The server sent the whole file.
+                offset = 0
+            elif not (resp.getheader('Content-Range') or '').startswith('bytes %s-'%offset):
+                resp.close()
+                raise emdash.transport.HTTPError(resp.status, resp.reason, "Unexpected Content-Range: %s"%resp.getheader('Content-Range'))
+            else:
+                self.log("Resuming download at %s of %s bytes"%(offset, size))
+        else:
+            resp.read()
+            resp.close()
+            if resp.status == 416:
+                # Our .part file doesn't fit the server's file; start over.
+                os.unlink(part)
+            raise emdash.transport.HTTPError(resp.status, resp.reason, "Error: %s %s"%(resp.status, resp.reason))
+
+        # The digest covers the whole file, including earlier attempts.
+        digest = emdash.transport.Digest()
+        output = None
+        count = 0
+        with open(part, 'r+b' if offset else 'wb') as f:
+            if offset:
+                digest.update_file(f, offset)
+            f.seek(offset)
+            f.truncate()
+            if gunzip:
+                output = emdash.transport.GunzipWriter(f)
+            if resp.status in (200, 206):
+                try:
+                    count = opener.save(resp, output or f, size=size, offset=offset, callback=digest.update)
+                    if output:
+                        output.flush()
+                except Exception:
+                    # A decompressed .part can't be resumed; don't leave it behind.
+                    if output:
+                        f.close()
+                        os.unlink(part)
+                    raise
+
+        self._download_finish(part, filename, digest, size, md5, output=output and output.digest)
+        return count
+
+    def _download_segments(self, opener, path, segments, filename, size, md5=None):
+        # Segments are written out of order, so hash the file once it's complete.
+        # After a failure, the file and its checkpoint are kept to resume from.
+        try:
+            count = opener.fetch(path, segments, size, key=md5)
+        except emdash.transport.RangeNotSupported:
+            opener.discard(segments)
+            raise
+        digest = emdash.transport.Digest()
+        with open(segments, 'rb') as f:
+            digest.update_file(f, int(size))
+        self._download_finish(segments, filename, digest, size, md5)
+        return count
+
+    def _download_finish(self, part, filename, digest, size=None, md5=None, output=None):
+        # output is the Digest of the decompressed file, if it differs from what was received.
+        self._download_verify(part, digest, size, md5)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.unlink(filename)
+        os.rename(part, filename)
+        # Remember the digest, so a later run can skip this file without reading it.
+        if output:
+            emdash.transport.digest_cache().add(filename, output, source_md5=digest.md5.hexdigest(), source_size=digest.size)
+        else:
+            emdash.transport.digest_cache().add(filename, digest)
+
+    def _download_verify(self, part, digest, size=None, md5=None):
+        # A mismatch means the .part file is bad; remove it so the retry starts over.
+        problem = None
+        if size is not None and digest.size != int(size):
+            problem = "Size mismatch: %s bytes, expected %s"%(digest.size, size)
+        elif md5 and digest.md5.hexdigest() != md5:
+            problem = "Checksum mismatch: md5 %s, expected %s"%(digest.md5.hexdigest(), md5)
+        if problem:
+            os.unlink(part)
+            raise Exception, "%s: %s"%(problem, os.path.basename(part))
 
     def _retry(self, method, *args, **kwargs):
-        pass
+        """Call method, retrying transient and server errors with backoff.
+
+        Auth and permanent errors are raised immediately. This blocks the
+        calling thread, so it's meant for short requests; whole transfers
+        are retried by the caller (see UploadThread).
+        """
+        attempt = 0
+        while True:
+            emdash.engine.check_cancelled()
+            try:
+                return method(*args, **kwargs)
+            except emdash.engine.Cancelled:
+                raise
+            except Exception, e:
+                attempt += 1
+                kind, delay = self.retry_policy.retry(e, attempt)
+                if delay is None:
+                    raise
+                self.log("Request failed (%s: %s); retry %s in %0.1f s"%(kind, e, attempt, delay))
+                time.sleep(delay)
 
 class FileHandler(Handler):
     ##### Polling interface #####
@@ -205,7 +584,10 @@ class FileHandler(Handler):
             item = self.check(filename)
             if item:
                 ret.append(item)
-        return ret
+        # Leave out items the ledger says are already uploaded.
+        paths = dict((item, self.uploaded_paths(item)) for item in ret)
+        done = emdash.ledger.ledger().lookup([i for v in paths.values() for i in v])
+        return [item for item in ret if not all(done.get(i, {}).get('record') for i in paths[item])]
 
     def check(self, item):
         if not self.exts:
@@ -239,8 +621,8 @@ class FileHandler(Handler):
         self.log("\n--- Starting upload: %s ---"%self.name)
         self.log("Checking for previously uploaded files...")
 
-        # Check JSON
-        check = self.sidecar_read(self.name)
+        # Check the upload ledger
+        check = self.uploaded_read(self.name)
         if check.get('name'):
             self.log("File already exists in database -- check %s"%check.get('name'))
             return check
@@ -250,6 +632,13 @@ class FileHandler(Handler):
             self.log("Waiting %s seconds before proceeding"%self.wait)
             time.sleep(self.wait)
 
+        # Don't send content that is already on the server.
+        check = self.dedup(self.name)
+        if check:
+            self.log("File already exists in database -- check %s"%check.get('name'))
+            self.uploaded_write(self.name, check)
+            return check
+
         # Data to upload
         fileobj = open(self.name, "rb")
 
@@ -276,8 +665,13 @@ class FileHandler(Handler):
         # ... default is PUT -- much faster, less memory.
         rec = self._upload_put(path, qs)
 
-        # Write out the sidecar file.
-        self.sidecar_write(self.name, {"name":rec.get('name')})
+        # Record the upload. The record exists, so don't let a retry create another.
+        try:
+            check = {"name":rec.get('name')}
+            check.update(self.checksums(self.name))
+            self.uploaded_write(self.name, check)
+        except Exception, e:
+            raise emdash.retry.PermanentError, "Uploaded to %s, but could not record the upload: %s"%(rec.get('name'), e)
 
         # Return the updated (or new) record..
         return rec
@@ -292,32 +686,69 @@ class FileHandler(Handler):
         filename = self.data.get('filename')
         filesize = self.data.get('filesize')
         filemd5 = self.data.get('md5')
-        ctxid = emdash.config.get('ctxid')
-        host = emdash.config.get('host')
-        uri = "%s/download/%s/%s?ctxid=%s"%(host, name, filename, ctxid)
+        path = "/download/%s/%s?%s"%(name, urllib.quote(unicode(filename).encode('utf-8')), urllib.urlencode({'ctxid':emdash.config.get('ctxid')}))
         self.log("File: %s / %s bytes / md5 %s"%(filename, filesize, filemd5))
 
-        if os.path.exists(filename):
-            self.log("File exists! Skipping. Remove the file to retry.")
-            return
+        gunzip = self.download_gunzip()
+        filename = self.download_filename()
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        if os.path.exists(filename) and not emdash.config.get('overwrite'):
+            if gunzip:
+                ok = self._download_check_gunzip(filename, filesize, filemd5)
+            else:
+                ok = self._download_check(filename, filesize, filemd5)
+            if ok:
+                self.log("File exists and matches; skipping.")
+                return
             
-        self.log("Downloading: %s"%uri)
+        self.log("Downloading: %s"%path)
         t = time.time()
-        req = urllib2.urlopen(uri)
-        CHUNK = 1024 * 1024
-        count = 0
-        block = 0
-        with open(filename, 'wb') as fp:
-            while True:
-                chunk = req.read(CHUNK)
-                count += len(chunk)
-                block += 1
-                print "... %0.2f MB"%(count / float(1024*1024))
-                self.log(progress=(count/float(filesize or 1)))
-                if not chunk:
-                    break
-                fp.write(chunk)
+        # One .part file per binary, so two binaries can't write to the same one.
+        part = "%s.%s.part"%(filename, name.replace(':', '.'))
+        count = self._download(path, filename, size=filesize, md5=filemd5, gunzip=gunzip, part=part)
         self.log("Done! %0.2f MB / sec"%( (count / float(1024*1024)) / (time.time()-t)   ))
+        return filename
+
+    def download_gunzip(self):
+        # Stored .gz files are decompressed while downloading, unless --nogzip.
+        return (self.data.get('filename') or '').endswith('.gz') and not emdash.config.get('nogzip')
+
+    def download_filename(self):
+        """Local filename for the download; in the _dir directory, if set.
+
+        If _rename is set, the file is named for the binary, with the
+        file's extension: bdo.201202020000.dm3
+        """
+        filename = self.data.get('filename')
+        if self.download_gunzip():
+            filename = filename[:-3]
+        if self.data.get('_rename'):
+            filename = os.path.join(os.path.dirname(filename), self.data.get('name').replace(':', '.') + os.path.splitext(filename)[1])
+        if self.data.get('_dir'):
+            filename = os.path.join(self.data.get('_dir'), os.path.basename(filename))
+        return filename
+
+    def _download_check(self, filename, filesize=None, filemd5=None):
+        """Check an existing local file against the binary record: size, then md5."""
+        if filesize is not None and os.path.getsize(filename) != int(filesize):
+            self.log("File exists but its size differs; downloading again.")
+            return False
+        if filemd5 and emdash.transport.digest_cache().digest(filename).get('md5') != filemd5:
+            self.log("File exists but its md5 differs; downloading again.")
+            return False
+        return True
+
+    def _download_check_gunzip(self, filename, filesize=None, filemd5=None):
+        # The record describes the compressed file, so only a cached entry
+        # from an earlier download can tell us this file came from it.
+        entry = emdash.transport.digest_cache().get(filename)
+        if not entry or (filesize is not None and entry.get('source_size') != int(filesize)) or (filemd5 and entry.get('source_md5') != filemd5):
+            self.log("File exists but can't be matched to the compressed file; downloading again.")
+            return False
+        return True
             
 @Handler.register('all')
 class AllHandler(FileHandler):
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import emdash.config
+import emdash.log
+import emdash.transport
+
+##### Upload ledger #####
+
+def fingerprint(filename, sample=64*1024):
+    """Quick content fingerprint: the size, and the first and last sample bytes."""
+    size = os.path.getsize(filename)
+    h = hashlib.sha1(str(size))
+    with open(filename, 'rb') as f:
+        h.update(f.read(sample))
+        if size > sample:
+            f.seek(max(sample, size-sample))
+            h.update(f.read(sample))
+    return h.hexdigest()
+
+class Ledger(object):
+    """Local SQLite record of uploaded files, keyed by absolute path.
+
+    Each entry has the record the file went to, its digests, the bytes
+    sent, the file's size, mtime and content fingerprint when it was
+    uploaded, and when the entry was created and updated. Uses WAL mode,
+    so the uploader and other processes can read while it writes.
+    """
+    # Rows per query for bulk lookups; SQLite limits the number of parameters.
+    batch = 500
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                path TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                size INTEGER,
+                mtime REAL,
+                record TEXT,
+                md5 TEXT,
+                sha256 TEXT,
+                bytes INTEGER,
+                created TEXT,
+                updated TEXT
+            );
+            CREATE INDEX IF NOT EXISTS uploads_fingerprint ON uploads (fingerprint);
+            CREATE INDEX IF NOT EXISTS uploads_md5 ON uploads (md5);
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                dev INTEGER,
+                inode INTEGER,
+                size INTEGER,
+                mtime REAL,
+                fingerprint TEXT,
+                md5 TEXT,
+                sha256 TEXT,
+                PRIMARY KEY (dev, inode)
+            );
+        """)
+        self.conn.commit()
+
+    def get(self, filename):
+        """The entry for filename, or None. Doesn't check that the file is unchanged; see current()."""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM uploads WHERE path = ?", (os.path.abspath(filename),)).fetchone()
+        return row and dict(row)
+
+    def current(self, entry, filename):
+        """True if entry still describes filename: same size, mtime and fingerprint.
+
+        A file that was removed after uploading (e.g. a generated raw HDF)
+        still counts as uploaded. A new file at the same path does not.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return True
+        if entry.get('size') != st.st_size or entry.get('mtime') != st.st_mtime:
+            return False
+        return entry.get('fingerprint') == self.fingerprint(filename)['fingerprint']
+
+    def lookup(self, filenames):
+        """{filename: entry} for the filenames that have current entries."""
+        paths = dict((os.path.abspath(i), i) for i in filenames)
+        keys = list(paths)
+        ret = {}
+        with self.lock:
+            for i in range(0, len(keys), self.batch):
+                chunk = keys[i:i+self.batch]
+                query = "SELECT * FROM uploads WHERE path IN (%s)"%",".join("?"*len(chunk))
+                for row in self.conn.execute(query, chunk):
+                    ret[paths[row['path']]] = dict(row)
+        return dict((k, v) for k, v in ret.items() if self.current(v, k))
+
+    def find(self, fingerprint=None, md5=None):
+        """Entries with this fingerprint and/or md5."""
+        where = []
+        args = []
+        if fingerprint:
+            where.append("fingerprint = ?")
+            args.append(fingerprint)
+        if md5:
+            where.append("md5 = ?")
+            args.append(md5)
+        if not where:
+            return []
+        with self.lock:
+            return [dict(row) for row in self.conn.execute("SELECT * FROM uploads WHERE %s"%" AND ".join(where), args)]
+
+    def add(self, filename, record, md5=None, sha256=None, size=None, **kwargs):
+        """Record that filename was uploaded to record.
+
+        size is the number of bytes sent. The file's size, mtime and
+        fingerprint are read from disk, if it still exists.
+        """
+        path = os.path.abspath(filename)
+        entry = {'path':path, 'record':record, 'md5':md5, 'sha256':sha256, 'bytes':size}
+        if os.path.exists(path):
+            st = os.stat(path)
+            fp = self.fingerprint(path, md5=md5, sha256=sha256)
+            entry.update({'size':st.st_size, 'mtime':st.st_mtime, 'fingerprint':fp['fingerprint']})
+        entry.update(kwargs)
+        now = emdash.config.gettime()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT created FROM uploads WHERE path = ?", (path,)).fetchone()
+            entry['created'] = row['created'] if row else now
+            entry['updated'] = now
+            keys = sorted(entry)
+            self.conn.execute("INSERT OR REPLACE INTO uploads (%s) VALUES (%s)"%(", ".join(keys), ", ".join("?"*len(keys))), [entry[k] for k in keys])
+        return entry
+
+    def fingerprint(self, filename, full=False, md5=None, sha256=None):
+        """{'fingerprint', 'size', 'md5', 'sha256'} for filename.
+
+        Cached by inode, size and mtime, so a renamed or moved file isn't
+        read again. The full digests are computed only if full is set;
+        md5 and sha256, if given, are known digests to cache.
+        """
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino)
+        row = None
+        if st.st_ino:
+            with self.lock:
+                row = self.conn.execute("SELECT * FROM fingerprints WHERE dev = ? AND inode = ?", key).fetchone()
+        if row and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+            ret = dict(row)
+            changed = False
+        else:
+            ret = {'fingerprint':fingerprint(filename), 'size':st.st_size, 'md5':None, 'sha256':None}
+            changed = True
+        if md5 and md5 != ret['md5']:
+            ret.update({'md5':md5, 'sha256':sha256})
+            changed = True
+        elif full and not ret['md5']:
+            digest = emdash.transport.Digest()
+            with open(filename, 'rb') as f:
+                digest.update_file(f, st.st_size)
+            ret.update({'md5':digest.md5.hexdigest(), 'sha256':digest.sha256.hexdigest()})
+            changed = True
+        if st.st_ino and changed:
+            with self.lock, self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO fingerprints (dev, inode, size, mtime, fingerprint, md5, sha256) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key[0], key[1], st.st_size, st.st_mtime, ret['fingerprint'], ret['md5'], ret['sha256']))
+        return dict((k, ret[k]) for k in ['fingerprint', 'size', 'md5', 'sha256'])
+
+    def remove(self, filename):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM uploads WHERE path = ?", (os.path.abspath(filename),))
+
+    def close(self):
+        self.conn.close()
+
+_ledger = None
+_ledger_lock = threading.Lock()
+def ledger():
+    """The shared Ledger."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger(emdash.config.get('ledger'))
+    return _ledger
+
+##### Sidecar import #####
+
+def import_sidecars(paths, target=None, remove=False, log=None):
+    """Add the <file>.json sidecars found in paths (files or directories) to the ledger.
+
+    Returns the number imported. If remove is set, imported sidecars are deleted.
+    """
+    target = target or ledger()
+    log = log or emdash.log.msg
+    count = 0
+    for sidecar in _sidecars(paths):
+        filename = sidecar[:-len(".json")]
+        try:
+            with open(sidecar) as f:
+                check = json.load(f) or {}
+        except (IOError, ValueError), e:
+            log("Skipping %s: %s"%(sidecar, e))
+            continue
+        if not isinstance(check, dict) or not check.get('name'):
+            continue
+        target.add(filename, check.get('name'), md5=check.get('md5'), sha256=check.get('sha256'), size=check.get('size'))
+        count += 1
+        if remove:
+            os.unlink(sidecar)
+    return count
+
+def _sidecars(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    if f.endswith(".json") and not f.startswith("."):
+                        yield os.path.join(root, f)
+        elif path.endswith(".json"):
+            yield path
+        elif os.path.exists(path + ".json"):
+            yield path + ".json"
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Import EMDash upload sidecar files (<file>.json) into the upload ledger.")
+    parser.add_argument("--ledger", help="Ledger database", default=os.path.join(os.path.expanduser('~'), '.emdash', 'uploads.db'))
+    parser.add_argument("--remove", action="store_true", help="Delete sidecars after importing them", default=False)
+    parser.add_argument('paths', metavar='paths', nargs='+', help='Files or directories')
+    ns = parser.parse_args()
+    target = Ledger(ns.ledger)
+    count = import_sidecars(ns.paths, target=target, remove=ns.remove)
+    print "Imported %s sidecars into %s"%(count, target.filename)
+
+if __name__ == "__main__":
+    main()
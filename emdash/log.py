@@ -1,3 +1,5 @@
+import threading
+import time
 import traceback
 
 ##### Logging #####
@@ -12,6 +14,62 @@ def msg(*msg, **kwargs):
     for listener in listeners:
         listener(*msg, **kwargs)
 
+##### Progress #####
+# Transfers record their latest progress here, which is cheap. A sampler
+# thread sends the changed items to the progress listeners as one batch
+# per tick, instead of one message per chunk.
+progress_listeners = []
+progress_interval = 0.25
+_progress = {}
+_progress_lock = threading.Lock()
+_progress_thread = None
+
+def add_progress_listener(func):
+    """func(batch) is called with {name: {'progress':..., ...}} at most once per tick.
+
+    Listeners run in the sampler thread, without the progress lock, so a
+    slow listener (e.g. writing to a terminal) delays later ticks but not
+    the transfers.
+    """
+    global _progress_thread
+    with _progress_lock:
+        progress_listeners.append(func)
+        if _progress_thread is None:
+            _progress_thread = threading.Thread(target=_progress_run)
+            _progress_thread.daemon = True
+            _progress_thread.start()
+
+def remove_progress_listener(func):
+    with _progress_lock:
+        if func in progress_listeners:
+            progress_listeners.remove(func)
+
+def progress(name, value, **kwargs):
+    """Record the progress (0.0-1.0) of a transfer."""
+    kwargs['progress'] = value
+    with _progress_lock:
+        _progress[name] = kwargs
+
+def progress_clear(name):
+    """Drop any unsent progress for name, e.g. once the transfer is finished."""
+    with _progress_lock:
+        _progress.pop(name, None)
+
+def _progress_run():
+    global _progress
+    while True:
+        time.sleep(progress_interval)
+        with _progress_lock:
+            if not _progress:
+                continue
+            batch, _progress = _progress, {}
+            funcs = list(progress_listeners)
+        for listener in funcs:
+            try:
+                listener(batch)
+            except Exception, e:
+                error("Progress listener exception: %s"%e, exception=e)
+
 def error(*msg, **kwargs):
     msg = ' '.join(map(unicode, msg))
     print "*****", msg, "*****"
@@ -0,0 +1,812 @@
+import BaseHTTPServer
+import Cookie
+import SocketServer
+import cgi
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+import emdash.bandwidth
+
+##### Mock EMEN2 server #####
+
+# A local stand-in for an EMEN2 server, for testing and benchmarking the
+# transfer code without a live database. It implements the parts emdash
+# uses: record uploads (POST, chunked PUT, resumable and segmented PUT,
+# Content-Encoding), downloads with Range requests, and JSON-RPC at
+# /jsonrpc. Records and binaries are kept in memory; file data is
+# written to a data directory.
+#
+#   python -m emdash.mockserver --port 8080 --latency 0.05 --rate 10M --error_rate 0.01
+
+class RPCError(Exception):
+    code = -32000
+
+class AuthError(RPCError):
+    code = 401
+
+class Faults(object):
+    """Latency and fault injection.
+
+    Random faults apply to each request with the given probabilities.
+    inject() queues deterministic faults for the next matching requests.
+    """
+    def __init__(self, latency=0, jitter=0, error_rate=0, error_status=503, drop_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.queued = []
+        self.lock = threading.Lock()
+
+    def inject(self, status=None, drop=False, count=1, match=None):
+        """Fail the next count requests whose path matches the regex match.
+
+        The request gets an error status, or with drop=True, the connection
+        is closed halfway through the request body.
+        """
+        with self.lock:
+            self.queued.append({'status':status or self.error_status, 'drop':drop, 'count':count, 'match':match})
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.jitter * self.random.random())
+
+    def next(self, path):
+        """Return None, ('status', code) or ('drop', None) for this request."""
+        with self.lock:
+            for fault in self.queued:
+                if fault['match'] and not re.search(fault['match'], path):
+                    continue
+                fault['count'] -= 1
+                if fault['count'] <= 0:
+                    self.queued.remove(fault)
+                if fault['drop']:
+                    return 'drop', None
+                return 'status', fault['status']
+            r = self.random.random()
+        if r < self.drop_rate:
+            return 'drop', None
+        if r < self.drop_rate + self.error_rate:
+            return 'status', self.error_status
+        return None
+
+class Dropped(Exception):
+    pass
+
+class ThrottledReader(object):
+    """Request body reader, limited by a TokenBucket; can drop the connection after `drop` bytes."""
+    def __init__(self, fileobj, bucket, drop=None):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.drop = drop
+        self.count = 0
+
+    def read(self, size=-1):
+        return self._check(self.fileobj.read(size))
+
+    def readline(self, size=-1):
+        return self._check(self.fileobj.readline(size))
+
+    def _check(self, data):
+        self.count += len(data)
+        if self.drop is not None and self.count >= self.drop:
+            raise Dropped
+        self.bucket.consume(len(data))
+        return data
+
+class Decoder(object):
+    """Streaming decoder for a request Content-Encoding."""
+    def __init__(self, encoding):
+        if encoding in (None, '', 'identity'):
+            self.decoder = None
+        elif encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+        elif encoding == 'zstd' and zstandard:
+            self.decoder = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == 'lz4' and lz4:
+            self.decoder = lz4.frame.LZ4FrameDecompressor()
+        else:
+            raise ValueError, "Unsupported Content-Encoding: %s"%encoding
+
+    def decompress(self, data):
+        if self.decoder is None:
+            return data
+        return self.decoder.decompress(data)
+
+    def flush(self):
+        flush = getattr(self.decoder, 'flush', None)
+        return (flush and flush()) or ''
+
+class Store(object):
+    """Records, binaries and upload sessions."""
+    def __init__(self, datadir=None, users=None):
+        self.datadir = datadir or tempfile.mkdtemp(prefix='emdash-mock-')
+        self.users = users
+        self.lock = threading.RLock()
+        self.contexts = {}
+        self.records = {}
+        self.binaries = {}
+        self.sessions = {}
+        self.counter = 0
+        self.records['0'] = self._newrec('0', 'root', {})
+
+    ##### Contexts #####
+
+    def login(self, username=None, password=None):
+        if self.users is not None and self.users.get(username) != password:
+            raise AuthError, "Invalid username or password"
+        ctxid = uuid.uuid4().hex
+        self.contexts[ctxid] = username or 'anonymous'
+        return ctxid
+
+    def check(self, ctxid):
+        """Return the user for ctxid; raises AuthError if login is required."""
+        if self.users is None:
+            return self.contexts.get(ctxid, 'anonymous')
+        if ctxid not in self.contexts:
+            raise AuthError, "Invalid or expired ctxid"
+        return self.contexts[ctxid]
+
+    def logout(self, ctxid):
+        self.contexts.pop(ctxid, None)
+
+    ##### Records #####
+
+    def _newrec(self, name, rectype, params, parent=None):
+        rec = dict(params)
+        rec.update({'name':name, 'rectype':rectype, 'parents':[], 'children':[], 'creationtime':now(), 'modifytime':now()})
+        if parent is not None:
+            rec['parents'].append(parent)
+            self.records[parent]['children'].append(name)
+        return rec
+
+    def _nextname(self):
+        with self.lock:
+            self.counter += 1
+            while str(self.counter) in self.records:
+                self.counter += 1
+            return str(self.counter)
+
+    def record_get(self, names):
+        if isinstance(names, list):
+            return [self.records[i] for i in names if i in self.records]
+        if names not in self.records:
+            raise RPCError, "No such record: %s"%names
+        return self.records[names]
+
+    def record_new(self, parent, rectype, params):
+        with self.lock:
+            if parent not in self.records:
+                raise KeyError, parent
+            name = self._nextname()
+            self.records[name] = self._newrec(name, rectype, params, parent=parent)
+            return self.records[name]
+
+    def record_put(self, recs):
+        ret = []
+        with self.lock:
+            for rec in (recs if isinstance(recs, list) else [recs]):
+                rec = dict(rec)
+                name = rec.get('name')
+                if name is None or unicode(name).startswith('-') or name not in self.records:
+                    parents = rec.pop('parents', None) or []
+                    new = self.record_new(parents[0] if parents else '0', rec.pop('rectype', 'folder'), {})
+                    for k in ['name', 'children', 'creationtime']:
+                        rec.pop(k, None)
+                    new.update(rec)
+                    ret.append(new)
+                else:
+                    for k in ['parents', 'children', 'creationtime']:
+                        rec.pop(k, None)
+                    rec['modifytime'] = now()
+                    self.records[name].update(rec)
+                    ret.append(self.records[name])
+        return ret if isinstance(recs, list) else ret[0]
+
+    def children(self, name, recurse=1, rectype=None):
+        found = set()
+        stack = [(name, 0)]
+        while stack:
+            n, depth = stack.pop()
+            if recurse >= 0 and depth >= max(recurse, 1):
+                continue
+            for child in self.records.get(n, {}).get('children', []):
+                if child not in found:
+                    found.add(child)
+                    stack.append((child, depth+1))
+        if rectype:
+            rectypes = rectype if isinstance(rectype, list) else [rectype]
+            found = set(i for i in found if any(fnmatch.fnmatch(self.records[i]['rectype'], r) for r in rectypes))
+        return sorted(found, key=int)
+
+    def pclink(self, parent, child):
+        with self.lock:
+            for name in [parent, child]:
+                if name not in self.records:
+                    raise RPCError, "No such record: %s"%name
+            if child not in self.records[parent]['children']:
+                self.records[parent]['children'].append(child)
+                self.records[child]['parents'].append(parent)
+                self.records[parent]['modifytime'] = self.records[child]['modifytime'] = now()
+
+    ##### Binaries #####
+
+    def binary_new(self, record, param, filename, path, size, md5):
+        with self.lock:
+            self.counter += 1
+            name = "bdo:%s%06d"%(time.strftime("%Y%m%d%H%M%S"), self.counter)
+            bdo = {
+                'name':name,
+                'filename':filename,
+                'filesize':size,
+                'md5':md5,
+                'record':record,
+                'param':param,
+                'creationtime':now()
+            }
+            dest = os.path.join(self.datadir, name.replace(':', '_'))
+            os.rename(path, dest)
+            self.binaries[name] = dict(bdo, _path=dest)
+            rec = self.records[record]
+            if isinstance(rec.get(param), list):
+                rec[param].append(name)
+            else:
+                rec[param] = name
+            rec['modifytime'] = now()
+            return bdo
+
+    def binary_find(self, record=None, filename=None, md5=None, filesize=None, count=100):
+        records = record if isinstance(record, list) else ([record] if record else None)
+        if records is not None:
+            records = set(unicode(i) for i in records)
+        ret = []
+        for name in sorted(self.binaries):
+            bdo = self.binaries[name]
+            if records is not None and bdo['record'] not in records:
+                continue
+            if filename and bdo['filename'] != filename:
+                continue
+            if md5 and bdo['md5'] != md5:
+                continue
+            if filesize is not None and bdo['filesize'] != filesize:
+                continue
+            ret.append(public(bdo))
+            if count and len(ret) >= count:
+                break
+        return ret
+
+    ##### Upload sessions #####
+
+    def session(self, uid, size=None):
+        """Resumable or segmented upload state for an X-Upload-Id."""
+        with self.lock:
+            if uid not in self.sessions:
+                fd, path = tempfile.mkstemp(dir=self.datadir, prefix='upload-')
+                os.close(fd)
+                self.sessions[uid] = {'path':path, 'size':size, 'segments':set(), 'result':None, 'lock':threading.Lock()}
+            return self.sessions[uid]
+
+def now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+def public(bdo):
+    return dict((k, v) for k, v in bdo.items() if not k.startswith('_'))
+
+def md5file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+##### JSON-RPC #####
+
+class RPC(object):
+    """JSON-RPC methods, called as method(ctxid, *args, **kwargs)."""
+    def __init__(self, store):
+        self.store = store
+        self.methods = {
+            'login': self.login,
+            'auth.login': self.login,
+            'auth.logout': self.logout,
+            'auth.check.context': self.context,
+            'time.now': lambda ctxid: now(),
+            'record.get': self.record_get,
+            'record.new': self.record_new,
+            'record.put': self.record_put,
+            'record.update': self.record_update,
+            'record.validate': lambda ctxid, rec, *args, **kwargs: rec,
+            'record.render': self.record_render,
+            'record.findcomments': lambda ctxid, *args, **kwargs: [],
+            'rel.children': self.rel_children,
+            'rel.pclink': self.rel_pclink,
+            'binary.find': self.binary_find,
+            'binary.get': self.binary_get,
+        }
+
+    def call(self, method, params, ctxid):
+        if method not in self.methods:
+            raise RPCError, "No such method: %s"%method
+        if method not in ('login', 'auth.login'):
+            self.store.check(ctxid)
+        if isinstance(params, dict):
+            return self.methods[method](ctxid, **dict((str(k), v) for k, v in params.items()))
+        return self.methods[method](ctxid, *(params or []))
+
+    def login(self, ctxid, username=None, password=None):
+        return self.store.login(username, password)
+
+    def logout(self, ctxid):
+        self.store.logout(ctxid)
+
+    def context(self, ctxid):
+        return self.store.check(ctxid), []
+
+    def record_get(self, ctxid, names, *args, **kwargs):
+        return self.store.record_get(names)
+
+    def record_new(self, ctxid, rectype=None, inherit=None, **kwargs):
+        return {'name':None, 'rectype':rectype, 'parents':list(inherit or []), 'children':[]}
+
+    def record_put(self, ctxid, recs, *args, **kwargs):
+        return self.store.record_put(recs)
+
+    def record_update(self, ctxid, names, update, *args, **kwargs):
+        recs = self.store.record_get(names)
+        for rec in (recs if isinstance(recs, list) else [recs]):
+            rec.update(update)
+        return recs
+
+    def record_render(self, ctxid, names, *args, **kwargs):
+        recs = self.store.record_get(names if isinstance(names, list) else [names])
+        ret = dict((rec['name'], "%s %s"%(rec['rectype'], rec['name'])) for rec in recs)
+        return ret if isinstance(names, list) else ret.get(names)
+
+    def rel_children(self, ctxid, names, recurse=1, rectype=None, *args, **kwargs):
+        if isinstance(names, list):
+            return dict((i, self.store.children(i, recurse, rectype)) for i in names)
+        return self.store.children(names, recurse, rectype)
+
+    def rel_pclink(self, ctxid, parent, child, *args, **kwargs):
+        self.store.pclink(parent, child)
+
+    def binary_find(self, ctxid, record=None, filename=None, md5=None, filesize=None, count=100, **kwargs):
+        return self.store.binary_find(record=record, filename=filename, md5=md5, filesize=filesize, count=count)
+
+    def binary_get(self, ctxid, names, *args, **kwargs):
+        if isinstance(names, list):
+            return [public(self.store.binaries[i]) for i in names if i in self.store.binaries]
+        return public(self.store.binaries[names])
+
+##### HTTP #####
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'EMEN2Mock/1.0'
+    blocksize = 1024*1024
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def do_GET(self):
+        self._handle(self.do_download)
+
+    def do_HEAD(self):
+        self._handle(self.do_download)
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') == '/jsonrpc':
+            self._handle(self.do_rpc)
+        else:
+            self._handle(self.do_upload_post)
+
+    def do_PUT(self):
+        self._handle(self.do_upload_put)
+
+    def _handle(self, method):
+        url = urlparse.urlparse(self.path)
+        self.query = dict((k, v[-1]) for k, v in urlparse.parse_qs(url.query, keep_blank_values=True).items())
+        self.drop = None
+        self.server.faults.delay()
+        fault = self.server.faults.next(url.path)
+        if fault and fault[0] == 'status':
+            self.close_connection = 1
+            return self._reply(fault[1], json.dumps({'error':'Injected fault'}))
+        if fault and fault[0] == 'drop':
+            self.drop = self._length() // 2
+        self.body = ThrottledReader(self.rfile, self.server.bucket_in, drop=self.drop)
+        try:
+            method(url.path)
+        except Dropped:
+            self.close_connection = 1
+        except AuthError, e:
+            self._reply(401, json.dumps({'error':unicode(e)}))
+        except (KeyError, ValueError), e:
+            self._reply(400, json.dumps({'error':unicode(e)}))
+
+    def _length(self):
+        return int(self.headers.get('Content-Length') or 0) or 64*1024
+
+    def _ctxid(self):
+        ctxid = self.query.get('ctxid')
+        if not ctxid and self.headers.get('Cookie'):
+            cookie = Cookie.SimpleCookie(self.headers.get('Cookie'))
+            if 'ctxid' in cookie:
+                ctxid = cookie['ctxid'].value
+        return ctxid
+
+    def _reply(self, status, body='', headers=None):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Content-Type', 'application/json')
+        headers.setdefault('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self._write(body)
+
+    def _write(self, data):
+        for i in range(0, len(data), self.blocksize):
+            chunk = data[i:i+self.blocksize]
+            self.server.bucket_out.consume(len(chunk))
+            self.wfile.write(chunk)
+
+    def _body(self):
+        """Yield the decoded request body: chunked or Content-Length, with Content-Encoding."""
+        decoder = Decoder(self.headers.get('Content-Encoding'))
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.body.readline().split(';')[0].strip() or '0', 16)
+                if not size:
+                    # Trailers end with an empty line.
+                    while self.body.readline().strip():
+                        pass
+                    break
+                data = self.body.read(size)
+                self.body.readline()
+                yield decoder.decompress(data)
+        else:
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining > 0:
+                data = self.body.read(min(self.blocksize, remaining))
+                if not data:
+                    raise Dropped
+                remaining -= len(data)
+                yield decoder.decompress(data)
+        yield decoder.flush()
+
+    def _body_to(self, f):
+        md5 = hashlib.md5()
+        size = 0
+        for data in self._body():
+            f.write(data)
+            md5.update(data)
+            size += len(data)
+        return size, md5.hexdigest()
+
+    ##### JSON-RPC #####
+
+    def do_rpc(self, path):
+        request = json.loads(''.join(self._body()))
+        if isinstance(request, list):
+            response = [self._rpc(i) for i in request]
+        else:
+            response = self._rpc(request)
+        self._reply(200, json.dumps(response))
+
+    def _rpc(self, request):
+        ret = {'jsonrpc':'2.0', 'id':request.get('id')}
+        try:
+            ret['result'] = self.server.rpc.call(request.get('method'), request.get('params'), self._ctxid())
+        except RPCError, e:
+            ret['error'] = {'code':e.code, 'message':unicode(e)}
+        except Exception, e:
+            ret['error'] = {'code':RPCError.code, 'message':"%s: %s"%(e.__class__.__name__, e)}
+        return ret
+
+    ##### Uploads #####
+
+    def _target(self, path):
+        """Parse /record/<name>/new/<rectype>/ or /record/<name>/edit/."""
+        m = re.match(r'^/record/([^/]+)/(?:new/([^/]+)|(edit))/?$', path)
+        if not m:
+            raise KeyError, "Unknown path: %s"%path
+        name, rectype, edit = m.groups()
+        if name not in self.server.store.records:
+            raise KeyError, "No such record: %s"%name
+        return name, rectype
+
+    def _params(self, items):
+        return dict((k, v) for k, v in items if k != 'ctxid' and not k.startswith('_'))
+
+    def _commit(self, path, files, params):
+        """Create or edit the record, attach the (param, filename, path, size, md5) files, and reply."""
+        store = self.server.store
+        name, rectype = self._target(path)
+        with store.lock:
+            if rectype:
+                rec = store.record_new(name, rectype, params)
+            else:
+                rec = store.records[name]
+                rec.update(params)
+            for param, filename, tmp, size, md5 in files:
+                store.binary_new(rec['name'], param, filename, tmp, size, md5)
+            return dict(rec)
+
+    def _tempfile(self):
+        fd, path = tempfile.mkstemp(dir=self.server.store.datadir, prefix='upload-')
+        return os.fdopen(fd, 'wb'), path
+
+    def do_upload_post(self, path):
+        self._target(path)
+        # Read the form first; the ctxid may be one of its fields.
+        form = cgi.FieldStorage(fp=self.body, headers=self.headers, environ={
+            'REQUEST_METHOD':'POST',
+            'CONTENT_TYPE':self.headers.get('Content-Type'),
+            'CONTENT_LENGTH':self.headers.get('Content-Length')
+        })
+        params = []
+        files = []
+        for key in form.keys():
+            items = form[key] if isinstance(form[key], list) else [form[key]]
+            for item in items:
+                if item.filename:
+                    f, tmp = self._tempfile()
+                    md5 = hashlib.md5()
+                    size = 0
+                    for chunk in iter(lambda: item.file.read(self.blocksize), ''):
+                        f.write(chunk)
+                        md5.update(chunk)
+                        size += len(chunk)
+                    f.close()
+                    files.append((key, item.filename, tmp, size, md5.hexdigest()))
+                else:
+                    params.append((key, item.value))
+        self.server.store.check(dict(params).get('ctxid') or self._ctxid())
+        params = self._params(params+self.query.items())
+        self._reply(200, json.dumps(self._commit(path, files, params)))
+
+    def do_upload_put(self, path):
+        self.server.store.check(self._ctxid())
+        self._target(path)
+        uid = self.headers.get('X-Upload-Id')
+        if self.headers.get('X-Upload-Commit'):
+            return self._put_commit(path, uid, int(self.headers.get('X-Upload-Commit')))
+        if uid and self.headers.get('X-Upload-Segment') is not None:
+            return self._put_segment(path, uid)
+        if uid and self.headers.get('Content-Range'):
+            return self._put_resumable(path, uid)
+        f, tmp = self._tempfile()
+        try:
+            size, md5 = self._body_to(f)
+        finally:
+            f.close()
+        self._put_finish(path, tmp, size, md5)
+
+    def _put_finish(self, path, tmp, size, md5):
+        param = self.headers.get('X-File-Param') or 'file_binary'
+        filename = self.headers.get('X-File-Name') or 'upload'
+        rec = self._commit(path, [(param, filename, tmp, size, md5)], self._params(self.query.items()))
+        self._reply(200, json.dumps(rec))
+        return rec
+
+    def _range(self):
+        # "bytes <start>-<end>/<size>" or "bytes */<size>"
+        m = re.match(r'bytes (\*|(\d+)-(\d+))/(\d+)', self.headers.get('Content-Range', ''))
+        if not m:
+            raise ValueError, "Bad Content-Range: %s"%self.headers.get('Content-Range')
+        _, start, end, size = m.groups()
+        return (start and int(start)), (end and int(end)), int(size)
+
+    def _put_resumable(self, path, uid):
+        store = self.server.store
+        start, end, size = self._range()
+        if start is None:
+            # Status query.
+            session = store.sessions.get(uid)
+            if not session:
+                return self._reply(404)
+            if session['result']:
+                return self._reply(200, json.dumps(session['result']))
+            have = os.path.getsize(session['path'])
+            return self._reply(308, headers={'Range':'bytes=0-%s'%(have-1)} if have else {})
+
+        session = store.session(uid, size)
+        with session['lock']:
+            have = os.path.getsize(session['path'])
+            if start > have:
+                return self._reply(308, headers={'Range':'bytes=0-%s'%(have-1)} if have else {})
+            with open(session['path'], 'r+b') as f:
+                f.truncate(start)
+                f.seek(start)
+                try:
+                    for data in self._body():
+                        f.write(data)
+                finally:
+                    f.flush()
+            have = os.path.getsize(session['path'])
+            if have < size:
+                return self._reply(308, headers={'Range':'bytes=0-%s'%(have-1)} if have else {})
+            session['result'] = self._put_finish(path, session['path'], have, md5file(session['path']))
+
+    def _put_segment(self, path, uid):
+        start, end, size = self._range()
+        session = self.server.store.session(uid, size)
+        index = int(self.headers.get('X-Upload-Segment'))
+        with open(session['path'], 'r+b') as f:
+            f.seek(start)
+            for data in self._body():
+                f.write(data)
+        with session['lock']:
+            session['segments'].add(index)
+        self._reply(308)
+
+    def _put_commit(self, path, uid, count):
+        session = self.server.store.sessions.get(uid)
+        if not session:
+            return self._reply(404)
+        missing = set(range(count)) - session['segments']
+        if missing:
+            return self._reply(400, json.dumps({'error':'Missing segments: %s'%sorted(missing)}))
+        size = os.path.getsize(session['path'])
+        if session['size'] is not None and size != session['size']:
+            return self._reply(400, json.dumps({'error':'Size mismatch: %s != %s'%(size, session['size'])}))
+        self.server.store.sessions.pop(uid, None)
+        self._put_finish(path, session['path'], size, md5file(session['path']))
+
+    ##### Downloads #####
+
+    def do_download(self, path):
+        self.server.store.check(self._ctxid())
+        m = re.match(r'^/download/([^/]+)(/.*)?$', path)
+        bdo = m and self.server.store.binaries.get(m.group(1))
+        if not bdo:
+            return self._reply(404, json.dumps({'error':'Not found'}))
+        filepath = bdo['_path']
+        headers = {'Content-Type':'application/octet-stream', 'Accept-Ranges':'bytes'}
+        size = os.path.getsize(filepath)
+        start, end = 0, size-1
+        status = 200
+        r = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if r and size:
+            if r.group(1):
+                start = int(r.group(1))
+                end = min(int(r.group(2) or size-1), size-1)
+            else:
+                start = max(0, size-int(r.group(2)))
+            if start > end:
+                return self._reply(416, headers={'Content-Range':'bytes */%s'%size})
+            status = 206
+            headers['Content-Range'] = 'bytes %s-%s/%s'%(start, end, size)
+        elif self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            filepath = self._gzipped(filepath)
+            headers['Content-Encoding'] = 'gzip'
+            size = os.path.getsize(filepath)
+            start, end = 0, size-1
+        headers['Content-Length'] = str(end-start+1)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        remaining = end-start+1
+        with open(filepath, 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                count = min(self.blocksize, remaining)
+                if self.drop is not None:
+                    count = min(count, max(self.drop - (end-start+1-remaining), 1))
+                chunk = f.read(count)
+                if not chunk:
+                    break
+                self._write(chunk)
+                remaining -= len(chunk)
+                if self.drop is not None and end-start+1-remaining >= self.drop:
+                    raise Dropped
+
+    def _gzipped(self, filepath):
+        gz = filepath + '.gz'
+        if not os.path.exists(gz):
+            tmp = '%s.%s'%(gz, uuid.uuid4().hex)
+            with open(filepath, 'rb') as src:
+                with gzip.open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, self.blocksize)
+            os.rename(tmp, gz)
+        return gz
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A mock EMEN2 server. Use start() to serve from a background thread.
+
+    rate and rate_out limit the request and response bandwidth (bytes/sec,
+    shared by all connections); faults takes the Faults arguments.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, datadir=None, users=None, rate=0, rate_out=None, gzip=False, verbose=False, **faults):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), RequestHandler)
+        self.store = Store(datadir=datadir, users=users)
+        self.rpc = RPC(self.store)
+        self.faults = Faults(**faults)
+        self.bucket_in = emdash.bandwidth.TokenBucket(rate)
+        self.bucket_out = emdash.bandwidth.TokenBucket(rate if rate_out is None else rate_out)
+        self.gzip = gzip
+        self.verbose = verbose
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s"%self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Mock EMEN2 server for testing and benchmarking emdash transfers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--datadir", help="Directory for uploaded files (default: a new temporary directory)")
+    parser.add_argument("--user", action="append", default=[], help="Require login: username:password (repeatable)")
+    parser.add_argument("--rate", help="Bandwidth cap for requests, e.g. 10M", default=None)
+    parser.add_argument("--rate_out", help="Bandwidth cap for responses (default: same as --rate)", default=None)
+    parser.add_argument("--latency", type=float, help="Seconds added to each request", default=0)
+    parser.add_argument("--jitter", type=float, help="Random extra seconds added to each request", default=0)
+    parser.add_argument("--error_rate", type=float, help="Fraction of requests answered with --error_status", default=0)
+    parser.add_argument("--error_status", type=int, default=503)
+    parser.add_argument("--drop_rate", type=float, help="Fraction of requests dropped halfway through", default=0)
+    parser.add_argument("--seed", type=int, help="Random seed for fault injection")
+    parser.add_argument("--gzip", action="store_true", help="Send downloads gzip-encoded when the client accepts it", default=False)
+    parser.add_argument("--verbose", action="store_true", default=False)
+    ns = parser.parse_args()
+
+    users = dict(i.partition(':')[::2] for i in ns.user) or None
+    rate = emdash.bandwidth.parse_rate(ns.rate)
+    rate_out = None if ns.rate_out is None else emdash.bandwidth.parse_rate(ns.rate_out)
+    server = MockServer(
+        host=ns.host, port=ns.port, datadir=ns.datadir, users=users,
+        rate=rate, rate_out=rate_out, gzip=ns.gzip, verbose=ns.verbose,
+        latency=ns.latency, jitter=ns.jitter, error_rate=ns.error_rate,
+        error_status=ns.error_status, drop_rate=ns.drop_rate, seed=ns.seed)
+    print "Mock EMEN2 server at %s, data in %s"%(server.url, server.store.datadir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
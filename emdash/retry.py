@@ -0,0 +1,125 @@
+import heapq
+import httplib
+import itertools
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import emdash.log
+
+##### Error classification #####
+
+TRANSIENT = 'transient'   # network errors, timeouts, dropped connections
+SERVER = 'server'         # 5xx, 408, 429
+AUTH = 'auth'             # 401, 403: retrying won't help until login
+PERMANENT = 'permanent'   # other 4xx, local file errors, cancellation
+
+class PermanentError(Exception):
+    """A failure that retrying the transfer can't fix; e.g. after its record was created."""
+
+def status(e):
+    """HTTP status carried by an exception, if any."""
+    for attr in ['status', 'code']:
+        value = getattr(e, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def classify(e):
+    import emdash.engine
+    if isinstance(e, (emdash.engine.Cancelled, PermanentError)):
+        return PERMANENT
+    code = status(e)
+    if code is not None:
+        if code in (401, 403):
+            return AUTH
+        if code >= 500 or code in (408, 429):
+            return SERVER
+        if code >= 400:
+            return PERMANENT
+        return TRANSIENT
+    # socket.error is an IOError; check it before local file errors.
+    if isinstance(e, (socket.error, socket.timeout, httplib.HTTPException, urllib2.URLError)):
+        return TRANSIENT
+    if isinstance(e, EnvironmentError) and e.errno is not None:
+        return PERMANENT
+    # Unknown errors (including truncated files still being written) may clear up.
+    return TRANSIENT
+
+##### Backoff #####
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter, and an attempt budget per error class."""
+    def __init__(self, base=2.0, factor=2.0, maxdelay=300.0, jitter=0.5, attempts=None):
+        self.base = base
+        self.factor = factor
+        self.maxdelay = maxdelay
+        self.jitter = jitter
+        self.attempts = {TRANSIENT:10, SERVER:6, AUTH:0, PERMANENT:0}
+        self.attempts.update(attempts or {})
+
+    def retry(self, e, attempt):
+        """Return (kind, delay) for the attempt-th failure; delay is None if we should give up."""
+        kind = classify(e)
+        if attempt > self.attempts.get(kind, 0):
+            return kind, None
+        return kind, self.delay(attempt)
+
+    def delay(self, attempt):
+        delay = min(self.maxdelay, self.base * self.factor ** (attempt - 1))
+        # Spread retries out so failures at the same moment don't retry together.
+        return delay * (1 - self.jitter * random.random())
+
+default_policy = RetryPolicy()
+
+##### Delayed retries #####
+
+class RetryScheduler(object):
+    """Run callbacks at a later time from one timer thread.
+
+    Items waiting for a retry don't hold a transfer worker; the callback
+    (e.g. putting the item back on a queue) runs when the delay expires.
+    Scheduling a key again replaces its earlier callback.
+    """
+    def __init__(self):
+        self.heap = []
+        self.items = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, key, delay, callback, attempt=None, error=None):
+        when = time.time() + delay
+        with self.cond:
+            seq = next(self.counter)
+            self.items[key] = {'attempt':attempt, 'when':when, 'error':error, 'seq':seq}
+            heapq.heappush(self.heap, (when, seq, key, callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return when
+
+    def pending(self):
+        """{key: {'attempt':..., 'when':..., 'error':...}} for items waiting to retry."""
+        with self.cond:
+            return dict((k, {'attempt':v['attempt'], 'when':v['when'], 'error':v['error']}) for k, v in self.items.items())
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap and max(0.01, self.heap[0][0]-time.time()) or None)
+                when, seq, key, callback = heapq.heappop(self.heap)
+                item = self.items.get(key)
+                if not item or item['seq'] != seq:
+                    # Replaced by a later schedule() for this key.
+                    continue
+                del self.items[key]
+            try:
+                callback()
+            except Exception, e:
+                emdash.log.error("Retry callback exception: %s"%e, exception=e)
@@ -0,0 +1,251 @@
+import os
+import sqlite3
+import threading
+import time
+
+import emdash.config
+import emdash.console
+import emdash.discover
+import emdash.log
+
+##### Sync state #####
+
+class SyncState(object):
+    """Local SQLite database of what a mirror directory holds.
+
+    Records are stored with their server modifytime; binaries with their
+    md5, size and modifytime, and the size and mtime of the local file
+    when it was last synced.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS records (name TEXT PRIMARY KEY, modifytime TEXT);
+            CREATE TABLE IF NOT EXISTS binaries (
+                name TEXT PRIMARY KEY,
+                record TEXT,
+                filename TEXT,
+                filesize INTEGER,
+                md5 TEXT,
+                modifytime TEXT,
+                path TEXT,
+                local_size INTEGER,
+                local_mtime REAL,
+                synced TEXT,
+                deleted INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS binaries_record ON binaries (record);
+        """)
+        self.conn.commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def records(self):
+        """{record name: modifytime}"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT name, modifytime FROM records"))
+
+    def set_records(self, modifytimes):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO records (name, modifytime) VALUES (?, ?)", modifytimes.items())
+
+    def remove_records(self, names):
+        with self.lock, self.conn:
+            for name in names:
+                self.conn.execute("DELETE FROM records WHERE name = ?", (name,))
+                self.conn.execute("UPDATE binaries SET deleted = 1 WHERE record = ?", (name,))
+
+    def binaries(self, record=None, deleted=False):
+        """Binary rows as dicts; for one record, or all."""
+        query = "SELECT * FROM binaries WHERE deleted = ?"
+        args = [1 if deleted else 0]
+        if record is not None:
+            query += " AND record = ?"
+            args.append(record)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, args)]
+
+    def update_binaries(self, bdos):
+        """Add or update binaries from the server; changed files are marked unsynced."""
+        with self.lock, self.conn:
+            for bdo in bdos:
+                row = self.conn.execute("SELECT md5, filesize FROM binaries WHERE name = ?", (bdo.get('name'),)).fetchone()
+                values = (bdo.get('record'), bdo.get('filename'), bdo.get('filesize'), bdo.get('md5'), bdo.get('modifytime') or bdo.get('creationtime'), bdo.get('name'))
+                if row is None:
+                    self.conn.execute("INSERT INTO binaries (record, filename, filesize, md5, modifytime, name) VALUES (?, ?, ?, ?, ?, ?)", values)
+                elif (row['md5'], row['filesize']) != (bdo.get('md5'), bdo.get('filesize')):
+                    self.conn.execute("UPDATE binaries SET record = ?, filename = ?, filesize = ?, md5 = ?, modifytime = ?, synced = NULL, deleted = 0 WHERE name = ?", values)
+                else:
+                    self.conn.execute("UPDATE binaries SET record = ?, filename = ?, filesize = ?, md5 = ?, modifytime = ?, deleted = 0 WHERE name = ?", values)
+
+    def delete_binaries(self, names):
+        with self.lock, self.conn:
+            for name in names:
+                self.conn.execute("UPDATE binaries SET deleted = 1 WHERE name = ?", (name,))
+
+    def synced(self, name, path):
+        st = os.stat(path)
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE binaries SET path = ?, local_size = ?, local_mtime = ?, synced = ? WHERE name = ?",
+                (path, st.st_size, st.st_mtime, emdash.config.gettime(), name))
+
+    def remove(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM binaries WHERE name = ?", (name,))
+
+    def close(self):
+        self.conn.close()
+
+##### Sync #####
+
+class Sync(object):
+    """Mirror the binaries in a record subtree to a local directory.
+
+    Each run lists the subtree (one rel.children request) and the
+    records' modifytimes, and only asks for the binaries of records that
+    are new or have changed since the last run. Binaries are downloaded
+    if they are new, changed on the server, or the local file changed or
+    went missing. Files are saved as <directory>/<record>/<filename>.
+    """
+    # Records are fetched in batches of this many.
+    batch = 500
+
+    def __init__(self, names, directory, recurse=-1, delete=False, jobs=1, retries=3, state=None, db=None):
+        self.names = names
+        self.directory = directory
+        self.recurse = recurse
+        self.delete = delete
+        self.jobs = jobs
+        self.retries = retries
+        self.db = db
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.state = SyncState(state or os.path.join(directory, '.emdash_sync.db'))
+
+    def run(self):
+        """Sync once; returns a dict of counts."""
+        t = time.time()
+        db = self.db or emdash.config.db()
+        stats = {}
+        servertime = db.time.now()
+
+        # Find the records, and the ones that changed.
+        manifest = emdash.discover.Manifest(self.names)
+        emdash.discover.expand(db, manifest, self.recurse)
+        modifytimes = self._modifytimes(db, manifest)
+        known = self.state.records()
+        # A record changed in the same second as the last listing may have
+        # kept its modifytime, so check those again too.
+        last = self.state.get('servertime')
+        changed = [name for name in manifest.records
+            if not modifytimes.get(name) or known.get(name) != modifytimes[name] or (last and modifytimes[name] >= last)]
+        emdash.discover.find_binaries(db, manifest, changed, batch=self.batch)
+
+        # Update the state: binaries of the changed records, and removed records.
+        found = set(bdo.get('name') for bdo in manifest.bdos)
+        gone = []
+        for name in changed:
+            gone += [row['name'] for row in self.state.binaries(record=name) if row['name'] not in found]
+        self.state.delete_binaries(gone)
+        self.state.update_binaries(manifest.bdos)
+        removed = set(known) - set(manifest.records)
+        self.state.remove_records(removed)
+        self.state.set_records(dict((name, modifytimes.get(name)) for name in changed))
+        self.state.set('servertime', servertime)
+        stats.update({'records':len(manifest.records), 'changed':len(changed), 'removed':len(removed), 'calls':manifest.calls})
+
+        # Download new and changed binaries.
+        bdos = [self._bdo(row) for row in self.state.binaries() if not self._current(row)]
+        stats['download'] = len(bdos)
+        failed = []
+        if bdos:
+            failed = emdash.console.fetch(bdos, jobs=self.jobs, retries=self.retries, finished=self._finished)
+        stats['failed'] = len(failed)
+
+        # Remove files for binaries that are gone from the server.
+        deleted = self.state.binaries(deleted=True)
+        stats['deleted'] = len(deleted)
+        if self.delete:
+            for row in deleted:
+                self._remove(row)
+
+        stats['elapsed'] = time.time() - t
+        return stats
+
+    def _modifytimes(self, db, manifest):
+        ret = {}
+        for i in range(0, len(manifest.records), self.batch):
+            recs = db.record.get(manifest.records[i:i+self.batch])
+            manifest.calls += 1
+            for rec in recs:
+                ret[rec.get('name')] = rec.get('modifytime') or rec.get('creationtime')
+        return ret
+
+    def _bdo(self, row):
+        bdo = dict((k, row[k]) for k in ['name', 'record', 'filename', 'filesize', 'md5', 'modifytime'])
+        bdo['_dir'] = os.path.join(self.directory, row['record'])
+        return bdo
+
+    def _current(self, row):
+        # Synced, and the local file hasn't changed since.
+        if not row['synced'] or not row['path']:
+            return False
+        try:
+            st = os.stat(row['path'])
+        except OSError:
+            return False
+        return st.st_size == row['local_size'] and st.st_mtime == row['local_mtime']
+
+    def _finished(self, bdo, handler, result):
+        self.state.synced(bdo.get('name'), handler.download_filename())
+
+    def _remove(self, row):
+        path = row['path']
+        if path and os.path.exists(path):
+            emdash.log.msg("Removing %s"%path)
+            os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        self.state.remove(row['name'])
+
+##### Command line #####
+
+class SyncConfig(emdash.config.Config):
+    applicationname = "EMDash"
+    def add_options(self, parser):
+        parser.add_argument("--recurse", type=int, help="Recursion level", default=-1)
+        parser.add_argument("--delete", action="store_true", help="Remove local files for binaries deleted on the server", default=False)
+        parser.add_argument("--interval", type=int, help="Sync again every this many seconds (default: once)", default=0)
+        parser.add_argument("--state", help="Sync state database (default: <directory>/.emdash_sync.db)")
+        parser.add_argument("--nogzip", action="store_true", help="Do not decompress files", default=False)
+        parser.add_argument("--jobs", "-j", type=int, help="Number of files to download at once", default=1)
+        parser.add_argument("--retries", type=int, help="Attempts per file after the first failure", default=3)
+        parser.add_argument('directory', metavar='directory', nargs=1, help='Local directory')
+        parser.add_argument('names', metavar='names', nargs='+', help='Record names')
+
+def main():
+    ns = emdash.config.setconfig(SyncConfig)
+    emdash.config.login()
+    sync = Sync(ns.names, ns.directory[0], recurse=ns.recurse, delete=ns.delete, jobs=ns.jobs, retries=ns.retries, state=ns.state)
+    while True:
+        stats = sync.run()
+        print "--- Sync: %(records)s records, %(changed)s changed, %(download)s to download, %(failed)s failed, %(deleted)s deleted (%(calls)s requests, %(elapsed)0.1f s) ---"%stats
+        if not ns.interval:
+            return stats
+        time.sleep(ns.interval)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,39 @@
 #!/usr/bin/python
+import atexit
 import base64
+import hashlib
 import httplib
 import json
 import mimetools
 import mimetypes
+import mmap
 import os
+import select
 import socket
 import stat
+import threading
 import time
 import urllib
 import urllib2
-import cStringIO as StringIO
+import uuid
+import zlib
+import Queue
 
+import emdash.bandwidth
 import emdash.config
+import emdash.engine
+import emdash.retry
+
+# Optional compressors
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 class UploadFile(file):
     def __init__(self, *args, **kwargs):
@@ -23,29 +44,955 @@ class UploadFile(file):
         if name_prefix:
             self.name_upload = name_prefix + self.name_upload
 
+def filesize(fileobj):
+    # Streams that are not plain files may report their own (source) size.
+    if hasattr(fileobj, 'size'):
+        return fileobj.size
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except:
+        return 0
+
+def filename_upload(fileobj):
+    # Allow alternate names for upload.
+    try:
+        return fileobj.name_upload
+    except AttributeError:
+        return fileobj.name
+
+class Digest(object):
+    """md5 and sha256 of a byte stream, updated as the bytes go by."""
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def update_file(self, fileobj, length):
+        """Hash the next length bytes of fileobj."""
+        while length > 0:
+            chunk = fileobj.read(min(length, 1024*1024))
+            if not chunk:
+                break
+            self.update(chunk)
+            length -= len(chunk)
+
+    def hexdigests(self):
+        return {'md5':self.md5.hexdigest(), 'sha256':self.sha256.hexdigest(), 'size':self.size}
+
+class DigestCache(object):
+    """Digests of local files, keyed by path and checked against size and mtime.
+
+    Saved as JSON, so files that haven't changed since they were last
+    hashed (or downloaded) aren't read again.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        """Cached digests for filename, or None if it's unknown or has changed."""
+        st = os.stat(filename)
+        with self.lock:
+            entry = self._entries().get(os.path.abspath(filename))
+        if entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime:
+            return dict(entry)
+        return None
+
+    def digest(self, filename):
+        """Digests for filename, hashing it only if the cached entry is stale."""
+        entry = self.get(filename)
+        if entry:
+            return entry
+        st = os.stat(filename)
+        digest = Digest()
+        with open(filename, 'rb') as f:
+            digest.update_file(f, st.st_size)
+        return self.add(filename, digest, st)
+
+    def add(self, filename, digest, st=None, **extra):
+        """Record a Digest for the current contents of filename, with any extra values."""
+        st = st or os.stat(filename)
+        entry = digest.hexdigests()
+        entry.update(extra)
+        entry['mtime'] = st.st_mtime
+        with self.lock:
+            self._entries()[os.path.abspath(filename)] = entry
+            self.dirty = True
+        return dict(entry)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.filename:
+                return
+            entries = dict(self.entries)
+            self.dirty = False
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = "%s.%s.tmp"%(self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        os.rename(tmp, self.filename)
+
+    def _entries(self):
+        # Call with the lock held.
+        if self.entries is None:
+            self.entries = {}
+            try:
+                with open(self.filename) as f:
+                    self.entries = json.load(f) or {}
+            except (IOError, ValueError, TypeError):
+                pass
+        return self.entries
+
+_digest_cache = None
+_digest_cache_lock = threading.Lock()
+def digest_cache():
+    """The shared DigestCache; saved after each fetch(), and when the process exits."""
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is None:
+            _digest_cache = DigestCache(emdash.config.get('digest_cache'))
+            atexit.register(_digest_cache.save)
+    return _digest_cache
+
+class MultipartBody(object):
+    """A file-like multipart/form-data body.
+
+    Headers are kept as strings; file contents are read from disk only as
+    the body is consumed, so memory use is bounded by the read size.
+    """
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.pos = 0
+        # Digests to update as each file part is read, by part index.
+        self.digests = {}
+        # Current part, and offset into that part.
+        self._index = 0
+        self._offset = 0
+
+    def add_string(self, value):
+        self.parts.append((value, len(value)))
+        self.size += len(value)
+
+    def add_file(self, fileobj, digest=None):
+        # Snapshot the size now so Content-Length is exact, even if the
+        # file is still growing on disk.
+        size = filesize(fileobj)
+        self.parts.append((fileobj, size))
+        self.size += size
+        if digest:
+            self.digests[len(self.parts)-1] = digest
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        buf = []
+        want = size
+        while want > 0 and self._index < len(self.parts):
+            part, partsize = self.parts[self._index]
+            count = min(want, partsize - self._offset)
+            if isinstance(part, basestring):
+                chunk = part[self._offset:self._offset+count]
+            else:
+                if self._offset == 0:
+                    part.seek(0)
+                chunk = part.read(count)
+                if len(chunk) < count:
+                    raise IOError, "File truncated during upload: %s"%part.name
+                if self._index in self.digests:
+                    self.digests[self._index].update(chunk)
+            self._offset += len(chunk)
+            if self._offset >= partsize:
+                self._index += 1
+                self._offset = 0
+            buf.append(chunk)
+            want -= len(chunk)
+        data = ''.join(buf)
+        self.pos += len(data)
+        return data
+
+##### Compression #####
+
+class LZ4Compressor(object):
+    # Give lz4.frame the same compress/flush interface as zlib.
+    def __init__(self, level=None):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level or 0)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, ''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+def codecs():
+    """Available upload compression codecs."""
+    ret = ['gzip']
+    if zstandard:
+        ret.append('zstd')
+    if lz4:
+        ret.append('lz4')
+    return ret
+
+def compressor(codec, level=None):
+    if codec == 'gzip':
+        return zlib.compressobj(level or 6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    elif codec == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=level or 3).compressobj()
+    elif codec == 'lz4' and lz4:
+        return LZ4Compressor(level=level)
+    raise ValueError, "Compression not available: %s"%codec
+
+class CompressedReader(object):
+    """Read a file through a compressor running in a worker thread.
+
+    The worker reads and compresses ahead into a bounded queue while the
+    caller sends the previous output, so compression overlaps with the
+    network. tell() and size refer to the uncompressed source, so
+    progress is reported against the original file.
+    """
+    def __init__(self, fileobj, codec='gzip', level=None, blocksize=1024*1024, depth=4):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.name = fileobj.name
+        self.name_upload = filename_upload(fileobj)
+        self.size = filesize(fileobj)
+        self.blocksize = blocksize
+        # Digest of the uncompressed source.
+        self.digest = Digest()
+        # Source bytes consumed and compressed bytes produced.
+        self.consumed = 0
+        self.compressed = 0
+        self.closed = False
+        self._buf = ''
+        self._done = False
+        self._queue = Queue.Queue(maxsize=depth)
+        self._compressor = compressor(codec, level=level)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self.closed:
+                chunk = self.fileobj.read(self.blocksize)
+                if not chunk:
+                    self._put((self._compressor.flush(), 0))
+                    break
+                self.digest.update(chunk)
+                self._put((self._compressor.compress(chunk), len(chunk)))
+        except Exception, e:
+            self._put(e)
+        self._put(None)
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buf) < size):
+            item = self._queue.get()
+            if item is None:
+                self._done = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                data, count = item
+                self._buf += data
+                self.consumed += count
+                self.compressed += len(data)
+        if size is None or size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def tell(self):
+        return self.consumed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Let the worker stop before its file is closed.
+        self._thread.join()
+        self.fileobj.close()
+
+class GunzipWriter(object):
+    """Decompress gzip data as it is written, and write it to fileobj.
+
+    Handles multi-member files (e.g. from pigz). Output is produced in
+    blocks of at most blocksize, so memory use doesn't depend on the
+    compression ratio. Keeps a Digest of the decompressed output.
+    """
+    def __init__(self, fileobj, blocksize=1024*1024):
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.digest = Digest()
+        self._decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+    def write(self, data):
+        while data:
+            d = self._decompressor
+            self._write(d.decompress(data, self.blocksize))
+            data = d.unconsumed_tail
+            if not data and d.unused_data:
+                # Anything after the end of a member starts the next one.
+                data = d.unused_data
+                self._decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+    def flush(self):
+        self._write(self._decompressor.flush())
+        self.fileobj.flush()
+
+    def _write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.digest.update(data)
+
+##### Read-ahead #####
+
+# Filesystem types that are mounted over the network.
+network_fstypes = set(['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'ceph', 'glusterfs', 'fuse.sshfs', '9p'])
+
+def network_fs(filename):
+    """Return True if filename is on a network filesystem (Linux only)."""
+    try:
+        mounts = open('/proc/mounts').read().splitlines()
+    except EnvironmentError:
+        return False
+    path = os.path.realpath(filename)
+    best, fstype = '', None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount = fields[1].decode('string_escape') if '\\' in fields[1] else fields[1]
+        if (path == mount or path.startswith(mount.rstrip('/')+'/')) and len(mount) > len(best):
+            best, fstype = mount, fields[2]
+    return fstype in network_fstypes
+
+class ReadAhead(object):
+    """Read a file in a worker thread, ahead of the sender.
+
+    The reader fills a ring of `buffers` preallocated buffers and the
+    sender takes them in order, so disk reads overlap with network sends.
+    Iterating yields (buffer, count); the sender must release() each
+    buffer when it is done with it. stats counts how often each side had
+    to wait for the other, and for how long.
+    """
+    def __init__(self, fileobj, size, buffers=4, buffersize=4*1024*1024):
+        self.fileobj = fileobj
+        self.remaining = size - fileobj.tell()
+        self.closed = False
+        self.stats = {'buffers':buffers, 'buffersize':buffersize, 'reads':0, 'reader_stalls':0, 'reader_wait':0.0, 'sender_stalls':0, 'sender_wait':0.0}
+        self._free = Queue.Queue()
+        self._full = Queue.Queue()
+        for i in range(buffers):
+            self._free.put(bytearray(buffersize))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while self.remaining > 0:
+                buf = self._get(self._free, 'reader')
+                if buf is None:
+                    return
+                count = min(self.fileobj.readinto(buf), self.remaining)
+                if not count:
+                    raise IOError, "File truncated during upload: %s"%self.fileobj.name
+                self.remaining -= count
+                self.stats['reads'] += 1
+                self._full.put((buf, count))
+            self._full.put(None)
+        except Exception, e:
+            self._full.put(e)
+
+    def _get(self, queue, side):
+        try:
+            return queue.get_nowait()
+        except Queue.Empty:
+            pass
+        # The other side is behind; wait for it.
+        self.stats[side+'_stalls'] += 1
+        t = time.time()
+        try:
+            while not self.closed:
+                try:
+                    return queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+        finally:
+            self.stats[side+'_wait'] += time.time() - t
+
+    def __iter__(self):
+        while True:
+            item = self._get(self._full, 'sender')
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def release(self, buf):
+        self._free.put(buf)
+
+    def close(self):
+        self.closed = True
+
+    def summary(self):
+        return "network waited on disk %(sender_stalls)s times (%(sender_wait)0.2f s), disk waited on network %(reader_stalls)s times (%(reader_wait)0.2f s)"%self.stats
+
+##### Adaptive chunk size #####
+
+class ChunkSizer(object):
+    """Choose a send size from the measured throughput of a connection.
+
+    The chunk size tracks the amount of data that can be sent in roughly
+    `target` seconds, so fast links use large chunks (less per-chunk
+    overhead) and slow links keep progress updates frequent. It changes
+    by at most a factor of two per update and stays within bounds.
+    """
+    def __init__(self, chunksize=128*1024, minsize=16*1024, maxsize=8*1024*1024, target=0.25, smoothing=0.3):
+        self.chunksize = chunksize
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.target = target
+        self.smoothing = smoothing
+        # Measured rate, bytes/sec (exponential moving average).
+        self.rate = 0.0
+
+    def update(self, count, elapsed):
+        if count <= 0:
+            return self.chunksize
+        # Guard against timer resolution on very fast sends.
+        rate = count / max(elapsed, 1e-4)
+        if self.rate:
+            self.rate += self.smoothing * (rate - self.rate)
+        else:
+            self.rate = rate
+        size = self.rate * self.target
+        size = max(self.chunksize / 2, min(self.chunksize * 2, size))
+        size = max(self.minsize, min(self.maxsize, size))
+        # Keep sizes page-aligned.
+        self.chunksize = int(size) - int(size) % 4096
+        return self.chunksize
+
+##### Connection pool #####
+
+class ConnectionPool(object):
+    """Thread-safe pool of idle keep-alive HTTP connections, keyed by host.
+
+    Connections get a socket timeout (the timeout setting, unless given),
+    so a half-open connection fails instead of hanging a worker forever.
+    """
+    def __init__(self, maxidle=4, idle_timeout=60, timeout=None):
+        self.maxidle = maxidle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, host):
+        """Check out a healthy idle connection, or open a new one."""
+        while True:
+            with self.lock:
+                conns = self.idle.get(host) or []
+                if not conns:
+                    break
+                conn, t = conns.pop()
+            if time.time() - t < self.idle_timeout and self._alive(conn):
+                conn.reused = True
+                return conn
+            conn.close()
+        return self.connect(host)
+
+    def connect(self, host):
+        """Open a new connection, bypassing the idle connections."""
+        timeout = self.timeout
+        if timeout is None:
+            timeout = float(emdash.config.get('timeout') or 0) or None
+        conn = httplib.HTTPConnection(host, timeout=timeout)
+        conn.reused = False
+        return conn
+
+    def put(self, host, conn):
+        """Return a connection to the pool after the response was read."""
+        if conn.sock is None:
+            return
+        with self.lock:
+            conns = self.idle.setdefault(host, [])
+            if len(conns) < self.maxidle:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, t in conns:
+                conn.close()
+
+    def _alive(self, conn):
+        # An idle keep-alive socket should have nothing to read;
+        # if it is readable, the server has closed it (or sent junk).
+        if conn.sock is None:
+            return False
+        try:
+            r, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not r
+
+default_pool = ConnectionPool()
+
+class PooledResponse(object):
+    """Wrap an HTTPResponse; release the connection once the body is consumed."""
+    def __init__(self, resp, host, conn, pool):
+        self.resp = resp
+        self.host = host
+        self.conn = conn
+        self.pool = pool
+
+    def __getattr__(self, key):
+        return getattr(self.resp, key)
+
+    def read(self, *args):
+        data = self.resp.read(*args)
+        if self.resp.isclosed():
+            self.release()
+        return data
+
+    def close(self):
+        self.release()
+        self.resp.close()
+
+    def release(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        # Unread body, or server asked to close: connection can't be reused.
+        if self.resp.will_close or not self.resp.isclosed():
+            conn.close()
+        else:
+            self.pool.put(self.host, conn)
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """urllib2 handler that sends http:// requests over pooled connections."""
+    # Run before the default HTTPHandler.
+    handler_order = 400
+
+    def __init__(self, pool=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool or default_pool
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((k.title(), v) for k, v in headers.items())
+
+        while True:
+            conn = self.pool.get(host)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                resp = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                # A pooled connection may have gone stale; retry once on a new one.
+                if conn.reused:
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        resp = PooledResponse(resp, host, conn, self.pool)
+        resp.recv = resp.read
+        fp = socket._fileobject(resp, close=True)
+        r = urllib.addinfourl(fp, resp.msg, req.get_full_url())
+        r.code = resp.status
+        r.msg = resp.reason
+        return r
+
+##### Transport handlers #####
+
+class HTTPError(httplib.HTTPException):
+    """An error response from the server; keeps the status for retry decisions."""
+    def __init__(self, status, reason, msg=None):
+        httplib.HTTPException.__init__(self, msg or "%s %s"%(status, reason))
+        self.status = status
+        self.reason = reason
+
 class Handler(object):       
-    def __init__(self, headers=None, log=None):
+    def __init__(self, headers=None, log=None, progress=None, pool=None):
         self.headers = headers or {} 
         self.headers['User-Agent'] = emdash.config.get('USER_AGENT')
-        self.log = log or (lambda x:x)
+        self.log = log or (lambda *args, **kwargs: None)
+        self.progress = progress or (lambda *args, **kwargs: None)
+        self.pool = pool or default_pool
+        # Digests of the files sent, by local filename.
+        self.digests = {}
+
+    def _connect(self):
+        # httplib doesn't take scheme://
+        host = emdash.config.get('host').partition('://')[-1] 
+        return host, self.pool.get(host)
+
+    def _response(self, host, http):
+        return PooledResponse(http.getresponse(), host, http, self.pool)
+
+    def _request(self, method, path, headers, send=None, rewind=None):
+        """Send a request over a pooled connection; returns the response.
+
+        send(http), if given, sends the body. A reused connection may have
+        been closed, or gone half-open, while it was idle; if sending on it
+        fails, the request is sent once more on a new connection, after
+        rewind() resets the body. Without rewind, a body is not resent.
+        Errors reading the response are not retried: the server may have
+        acted on the request.
+        """
+        host, http = self._connect()
+        try:
+            http.request(method, path, headers=headers)
+            if send:
+                send(http)
+        except (socket.error, httplib.HTTPException), e:
+            http.close()
+            if not getattr(http, 'reused', False) or (send and not rewind):
+                raise
+            self.log("Idle connection failed (%s); reconnecting"%e)
+            if rewind:
+                rewind()
+            http = self.pool.connect(host)
+            http.request(method, path, headers=headers)
+            if send:
+                send(http)
+        return self._response(host, http)
+
+    def _rewinder(self, fileobj):
+        """A rewind() for _request that sends fileobj again from here, or None if it can't seek."""
+        if not isinstance(fileobj, file):
+            return None
+        start = fileobj.tell()
+        def rewind():
+            fileobj.seek(start)
+            self.digests.pop(fileobj.name, None)
+        return rewind
+
+    def _digest(self, fileobj):
+        """Return the Digest to update with the bytes of fileobj as they are sent.
+
+        Returns None for streams that hash their own source (CompressedReader).
+        """
+        own = getattr(fileobj, 'digest', None)
+        if own is not None:
+            self.digests[fileobj.name] = own
+            return None
+        if fileobj.name not in self.digests:
+            self.digests[fileobj.name] = Digest()
+        return self.digests[fileobj.name]
+
+    def _sizer(self, http):
+        # Keep the chunk sizer with the connection, so the measured rate
+        # carries over when a pooled connection is reused.
+        sizer = getattr(http, 'sizer', None)
+        if sizer is None:
+            sizer = http.sizer = ChunkSizer()
+        return sizer
+
+    def _send(self, http, sizer, count, *data):
+        # Throttling counts towards the measured rate, so the chunk size
+        # tracks the effective (limited) rate.
+        emdash.engine.check_cancelled()
+        t = time.time()
+        emdash.bandwidth.upload.consume(count)
+        for i in data:
+            http.send(i)
+        sizer.update(count, time.time()-t)
+
+    def _progress(self, sizer, progress):
+        self.progress(progress, chunksize=sizer.chunksize, rate=sizer.rate)
         
     def _data_files(self, data):
         data = data or {}
         files = {}
         newdata = {}
         for k,v in data.items():
-            if isinstance(v, file):
+            if isinstance(v, (file, CompressedReader)):
                 files[k] = v
             else:
                 newdata[k] = v
         return newdata, files
         
 class DownloadHandler(Handler):
+    def open(self, path, headers=None):
+        """GET path over a pooled keep-alive connection; returns the response."""
+        h = dict(self.headers)
+        h.update(headers or {})
+        return self._request('GET', path, h)
+
+    def save(self, resp, fileobj, size=None, offset=0, callback=None):
+        """Copy the response body to fileobj; returns the number of bytes written.
+
+        offset is where the body starts in the whole file, for progress.
+        """
+        sizer = self._sizer(resp)
+        count = 0
+        while True:
+            chunk = self._recv(resp, sizer)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+            count += len(chunk)
+            if callback:
+                callback(chunk)
+            self._progress(sizer, (offset+count)/float(size or 1))
+        resp.close()
+        length = resp.getheader('Content-Length')
+        if length is not None and count != int(length):
+            raise httplib.IncompleteRead('', int(length)-count)
+        return count
+
+    def _sizer(self, resp):
+        # Keep the sizer with the connection, as for uploads.
+        return super(DownloadHandler, self)._sizer(resp.conn or resp)
+
+    def _recv(self, resp, sizer):
+        emdash.engine.check_cancelled()
+        t = time.time()
+        chunk = resp.read(sizer.chunksize)
+        emdash.bandwidth.download.consume(len(chunk))
+        sizer.update(len(chunk), time.time()-t)
+        return chunk
+
+class RangeNotSupported(HTTPError):
+    """The server answered a Range request with the whole file."""
     pass
 
+class SegmentedDownloadHandler(DownloadHandler):
+    """Fetch one large file as byte ranges over several concurrent connections.
+
+    The file is split by size into equal ranges, each fetched with a
+    "Range: bytes=<start>-<end>" GET and written at its offset in a
+    preallocated file. Failed segments are retried individually.
+
+    Completed segments are checkpointed to <filename>.json: the file size,
+    the segments, and the indexes of those done. An interrupted download
+    fetches only the missing segments. The preallocated file is full size
+    from the start, so its size says nothing about what it holds; only
+    the checkpoint does.
+    """
+    # Don't split files into segments smaller than this.
+    minsegment = 16*1024*1024
+
+    def __init__(self, *args, **kwargs):
+        self.segments = kwargs.pop('segments', None) or int(emdash.config.get('segments', 1))
+        self.retries = kwargs.pop('retries', 3)
+        super(SegmentedDownloadHandler, self).__init__(*args, **kwargs)
+
+    def split(self, size):
+        """Return [(index, offset, length), ...], or [] if size isn't worth splitting."""
+        size = int(size or 0)
+        count = min(self.segments, size // self.minsegment)
+        if count < 2:
+            return []
+        length = -(-size // count)
+        return [(i, offset, min(length, size-offset)) for i, offset in enumerate(range(0, size, length))]
+
+    def fetch(self, path, filename, size, key=None):
+        """Download path into filename at its full size; returns the bytes received.
+
+        key (e.g. the md5) identifies the server's file; a checkpoint for
+        a different key or size is discarded and the download starts over.
+        """
+        size = int(size)
+        segments = self.split(size)
+        count = len(segments)
+        checkpoint = self._checkpoint_load(filename, size, segments, key)
+        done = checkpoint['done']
+        if done:
+            self.log("Resuming download: %s of %s segments done"%(len(done), count))
+        else:
+            self.log("Downloading %s bytes in %s segments"%(size, count))
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+            self._checkpoint_save(filename, checkpoint)
+        resumed = sum(length for index, offset, length in segments if index in done)
+        segments = [i for i in segments if i[0] not in done]
+
+        state = {'received':resumed, 'errors':[]}
+        lock = threading.Lock()
+        job = emdash.engine.current()
+        def progress(count):
+            with lock:
+                state['received'] += count
+                received = state['received']
+            self.progress(received/float(size))
+        def worker():
+            # Stop with the job that started us; each worker writes through its own file object.
+            emdash.engine.adopt(job)
+            f = open(filename, 'r+b')
+            try:
+                while not state['errors']:
+                    with lock:
+                        if not segments:
+                            return
+                        segment = segments.pop(0)
+                    try:
+                        self._segment_retry(path, f, size, segment, progress)
+                    except Exception, e:
+                        with lock:
+                            state['errors'].append((segment[0], e))
+                        continue
+                    with lock:
+                        done.append(segment[0])
+                        self._checkpoint_save(filename, checkpoint)
+            finally:
+                f.close()
+
+        threads = [threading.Thread(target=worker) for i in range(len(segments))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if state['errors']:
+            index, e = state['errors'][0]
+            if isinstance(e, (RangeNotSupported, emdash.engine.Cancelled)):
+                raise e
+            msg = "Download failed on segment %s: %s"%(index, e)
+            if getattr(e, 'status', None):
+                raise HTTPError(e.status, e.reason, msg)
+            raise httplib.HTTPException, msg
+        self._checkpoint_remove(filename)
+        return state['received'] - resumed
+
+    def discard(self, filename):
+        """Remove a partial download and its checkpoint."""
+        self._checkpoint_remove(filename)
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+    ##### Checkpoints #####
+
+    def _checkpoint_filename(self, filename):
+        return filename + ".json"
+
+    def _checkpoint_load(self, filename, size, segments, key=None):
+        try:
+            checkpoint = json.load(open(self._checkpoint_filename(filename), "r"))
+        except:
+            checkpoint = {}
+        segments = [list(i) for i in segments]
+        if (not os.path.exists(filename) or os.path.getsize(filename) != size
+                or checkpoint.get('size') != size or checkpoint.get('key') != key
+                or checkpoint.get('segments') != segments):
+            checkpoint = {'size':size, 'key':key, 'segments':segments, 'done':[]}
+        return checkpoint
+
+    def _checkpoint_save(self, filename, checkpoint):
+        # Written to a temporary file and renamed, so a kill never leaves half a checkpoint.
+        tmp = "%s.tmp"%self._checkpoint_filename(filename)
+        try:
+            with open(tmp, "w") as f:
+                json.dump(checkpoint, f)
+            if os.name == 'nt' and os.path.exists(self._checkpoint_filename(filename)):
+                os.unlink(self._checkpoint_filename(filename))
+            os.rename(tmp, self._checkpoint_filename(filename))
+        except (IOError, OSError), e:
+            self.log("Could not write download checkpoint: %s"%e)
+
+    def _checkpoint_remove(self, filename):
+        try:
+            os.unlink(self._checkpoint_filename(filename))
+        except OSError:
+            pass
+
+    def _segment_retry(self, path, fileobj, size, segment, progress):
+        index, offset, length = segment
+        for attempt in range(self.retries+1):
+            received = []
+            def callback(count):
+                received.append(count)
+                progress(count)
+            try:
+                return self._segment_recv(path, fileobj, size, segment, callback)
+            except RangeNotSupported:
+                raise
+            except (socket.error, httplib.HTTPException), e:
+                # Roll back this segment's progress before trying again.
+                progress(-sum(received))
+                kind = emdash.retry.classify(e)
+                if attempt >= self.retries or kind not in (emdash.retry.TRANSIENT, emdash.retry.SERVER):
+                    raise
+                delay = emdash.retry.default_policy.delay(attempt+1)
+                self.log("Segment %s failed (%s); retrying in %0.1f s"%(index, e, delay))
+                time.sleep(delay)
+
+    def _segment_recv(self, path, fileobj, size, segment, callback):
+        index, offset, length = segment
+        resp = self.open(path, headers={'Range':'bytes=%s-%s'%(offset, offset+length-1)})
+        if resp.status != 206:
+            resp.read()
+            resp.close()
+            if resp.status == 200:
+                raise RangeNotSupported(resp.status, resp.reason, "Server does not support Range requests")
+            raise HTTPError(resp.status, resp.reason)
+        if not (resp.getheader('Content-Range') or '').startswith('bytes %s-%s/'%(offset, offset+length-1)):
+            resp.close()
+            raise HTTPError(resp.status, resp.reason, "Unexpected Content-Range: %s"%resp.getheader('Content-Range'))
+        fileobj.seek(offset)
+        sizer = self._sizer(resp)
+        remaining = length
+        while remaining > 0:
+            chunk = self._recv(resp, sizer)
+            if not chunk:
+                break
+            chunk = chunk[:remaining]
+            fileobj.write(chunk)
+            remaining -= len(chunk)
+            callback(len(chunk))
+        resp.close()
+        if remaining:
+            raise httplib.IncompleteRead('', remaining)
+        fileobj.flush()
+
 class PutHandler(Handler): 
+    # Size of each memory-mapped window when sending regular files.
+    mmap_window = 64*1024*1024
+
     def open(self, path, data=None):
         """Implements Transfer-Encoding:Chunked over a PUT request."""
+        path, fileobj = self._prepare(path, data)
+        size = filesize(fileobj)
+
+        # Send over a pooled connection, and return the response.
+        send = lambda http: self._send_chunked(http, fileobj, size)
+        return self._request('PUT', path, self.headers, send=send, rewind=self._rewinder(fileobj))
+
+    def _prepare(self, path, data):
         data, files = self._data_files(data)
         
         # Get the file
@@ -53,16 +1000,7 @@ class PutHandler(Handler):
             raise Exception, "Must provide exactly ONE file for a HTTP PUT request."
 
         fileparam, fileobj = files.items()[0]
-        try:    
-            filesize = os.fstat(fileobj.fileno()).st_size
-        except:
-            filesize = 0
-        
-        # Allow alternate names for upload.
-        try:
-            filename = fileobj.name_upload
-        except AttributeError:
-            filename = fileobj.name
+        filename = filename_upload(fileobj)
 
         # Encode all the parameters in a query string.
         path = "%s?%s"%(path, urllib.urlencode(data))
@@ -71,29 +1009,407 @@ class PutHandler(Handler):
         self.headers['Transfer-Encoding'] = 'chunked'
         self.headers['X-File-Param'] = fileparam
         self.headers['X-File-Name'] = os.path.basename(filename)
-    
-        # Open connection
-        # httplib doesn't take scheme://
-        host = emdash.config.get('host').partition('://')[-1] 
-        http = httplib.HTTPConnection(host)
-        http.request('PUT', path, headers=self.headers)
-    
+        if isinstance(fileobj, CompressedReader):
+            self.headers['Content-Encoding'] = fileobj.codec
+        return path, fileobj
+
+    def _send_chunked(self, http, fileobj, size, callback=None):
+        digest = self._digest(fileobj)
+        if digest:
+            callback = self._digest_callback(digest, callback)
+
+        # Files on slow (network) storage are read ahead in a thread;
+        # other regular files are sent straight from a memory map.
+        buffers = self._readahead(fileobj, size)
+        if buffers:
+            return self._send_readahead(http, fileobj, size, buffers, callback=callback)
+        if self._mappable(fileobj, size) and self._send_mmap(http, fileobj, size, callback=callback):
+            return
+
         # Upload in chunks
-        chunksize = 128*1024        
+        sizer = self._sizer(http)
         while True:
             try:
-                chunk = fileobj.read(chunksize)
-                http.send('%X\r\n'%(len(chunk)))
-                http.send(chunk)
-                http.send('\r\n')
-                self.log(progress=(fileobj.tell()/float(filesize or 1)))
+                chunk = fileobj.read(sizer.chunksize)
+                self._send(http, sizer, len(chunk), '%X\r\n'%(len(chunk)), chunk, '\r\n')
+                if callback:
+                    callback(chunk)
+                self._progress(sizer, fileobj.tell()/float(size or 1))
             except socket.error:
                 raise
             if not chunk:
                 break
-    
-        # Return response...
-        return http.getresponse()
+
+    def _digest_callback(self, digest, callback=None):
+        def inner(chunk):
+            digest.update(chunk)
+            if callback:
+                callback(chunk)
+        return inner
+
+    def _readahead(self, fileobj, size):
+        """Number of read-ahead buffers to use for fileobj, or 0.
+
+        The readahead setting forces a buffer count (0 disables);
+        by default, files on network filesystems get 4 buffers.
+        """
+        if not isinstance(fileobj, file) or not self._mappable(fileobj, size):
+            return 0
+        buffers = emdash.config.get('readahead')
+        if buffers is None or buffers == '':
+            return 4 if network_fs(fileobj.name) else 0
+        return int(buffers)
+
+    def _send_readahead(self, http, fileobj, size, buffers, callback=None):
+        sizer = self._sizer(http)
+        pos = fileobj.tell()
+        buffersize = int(emdash.config.get('readahead_size') or 4) * 1024 * 1024
+        reader = ReadAhead(fileobj, size, buffers=buffers, buffersize=buffersize)
+        self.readahead_stats = reader.stats
+        try:
+            for buf, count in reader:
+                # Send each buffer in sizer-sized views, without copying.
+                offset = 0
+                while offset < count:
+                    n = min(sizer.chunksize, count-offset)
+                    chunk = buffer(buf, offset, n)
+                    self._send(http, sizer, n, '%X\r\n'%n, chunk, '\r\n')
+                    offset += n
+                    pos += n
+                    if callback:
+                        callback(chunk)
+                    self._progress(sizer, pos/float(size))
+                reader.release(buf)
+        finally:
+            reader.close()
+        http.send('0\r\n\r\n')
+        if callback:
+            callback('')
+        self.log("Read-ahead: %s"%reader.summary())
+
+    def _mappable(self, fileobj, size):
+        if not size or size <= fileobj.tell():
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+        except (AttributeError, EnvironmentError):
+            return False
+
+    def _send_mmap(self, http, fileobj, size, callback=None):
+        """Send from the current position to size using memory-mapped windows.
+
+        Chunks are buffer() views into the map, so file data is never
+        copied into Python strings; only the chunk framing is. Returns
+        False, having sent nothing, if the file can't be mapped; errors
+        while sending are raised.
+        """
+        sizer = self._sizer(http)
+        pos = first = fileobj.tell()
+        while pos < size:
+            # Map a bounded window at a time; whole-file maps can exhaust
+            # the address space of 32-bit Python.
+            start = pos - (pos % mmap.ALLOCATIONGRANULARITY)
+            length = min(self.mmap_window, size-start)
+            try:
+                m = mmap.mmap(fileobj.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+            except (EnvironmentError, ValueError), e:
+                if pos != first:
+                    raise
+                self.log("Could not memory-map %s: %s"%(fileobj.name, e))
+                return False
+            try:
+                while pos < start+length:
+                    count = min(sizer.chunksize, start+length-pos)
+                    chunk = buffer(m, pos-start, count)
+                    self._send(http, sizer, count, '%X\r\n'%count, chunk, '\r\n')
+                    pos += count
+                    if callback:
+                        callback(chunk)
+                    self._progress(sizer, pos/float(size))
+            finally:
+                m.close()
+            fileobj.seek(pos)
+        http.send('0\r\n\r\n')
+        if callback:
+            callback('')
+        return True
+
+class ResumablePutHandler(PutHandler):
+    """Chunked PUT that can continue an interrupted upload.
+
+    Each request carries an X-Upload-Id header. To resume, the client first
+    sends an empty PUT with "Content-Range: bytes */<size>"; the server
+    replies 308 with "Range: bytes=0-<last>" for the bytes it has stored
+    (no Range header if none). The rest of the file is then sent with
+    "Content-Range: bytes <offset>-<size-1>/<size>". A 308 reply to a data
+    request means the upload is still incomplete.
+
+    Progress is checkpointed to <filename>.upload.json: the upload id, the
+    file size and mtime, and an md5 for each block sent. Before resuming,
+    the block just below the server's offset is re-hashed to make sure the
+    file has not changed.
+    """
+    # Bytes between checkpoint writes.
+    blocksize = 8*1024*1024
+
+    def open(self, path, data=None):
+        path, fileobj = self._prepare(path, data)
+        st = os.fstat(fileobj.fileno())
+        size = st.st_size
+        if not size or not stat.S_ISREG(st.st_mode):
+            send = lambda http: self._send_chunked(http, fileobj, size)
+            return self._request('PUT', path, self.headers, send=send, rewind=self._rewinder(fileobj))
+
+        checkpoint = self._checkpoint_load(fileobj, st)
+        self.headers['X-Upload-Id'] = checkpoint['upload_id']
+        
+        # Ask the server where to continue.
+        offset = 0
+        if checkpoint['blocks']:
+            resp, offset = self._query_offset(path, size)
+            if resp:
+                self._checkpoint_remove(fileobj)
+                return resp
+            offset = self._checkpoint_verify(fileobj, checkpoint, offset)
+            if offset:
+                self.log("Resuming upload at %s of %s bytes"%(offset, size))
+                # The digest must cover the bytes sent in earlier attempts.
+                fileobj.seek(0)
+                self._digest(fileobj).update_file(fileobj, offset)
+
+        self.headers['Content-Range'] = 'bytes %s-%s/%s'%(offset, size-1, size)
+        fileobj.seek(offset)
+        block = {'offset':offset, 'length':0, 'md5':hashlib.md5()}
+        def callback(chunk):
+            block['length'] += len(chunk)
+            block['md5'].update(chunk)
+            if block['length'] >= self.blocksize or not chunk:
+                self._checkpoint_add(fileobj, checkpoint, block)
+                block.update({'offset':block['offset']+block['length'], 'length':0, 'md5':hashlib.md5()})
+        def send(http):
+            self._send_chunked(http, fileobj, size, callback=callback)
+        def rewind():
+            # Back to offset; the digest still covers only the bytes before it.
+            self.digests.pop(fileobj.name, None)
+            fileobj.seek(0)
+            self._digest(fileobj).update_file(fileobj, offset)
+            fileobj.seek(offset)
+            checkpoint['blocks'] = [i for i in checkpoint['blocks'] if i['offset']+i['length'] <= offset]
+            block.update({'offset':offset, 'length':0, 'md5':hashlib.md5()})
+        resp = self._request('PUT', path, self.headers, send=send, rewind=rewind)
+        if resp.status == 308:
+            resp.read()
+            resp.close()
+            raise httplib.HTTPException, "Upload incomplete: server did not acknowledge all %s bytes"%size
+        if resp.status in range(200, 300):
+            self._checkpoint_remove(fileobj)
+        return resp
+
+    def _query_offset(self, path, size):
+        """Returns (final response, 0) if the upload already completed, otherwise (None, offset)."""
+        headers = dict(self.headers)
+        headers.pop('Transfer-Encoding', None)
+        headers['Content-Length'] = '0'
+        headers['Content-Range'] = 'bytes */%s'%size
+        resp = self._request('PUT', path, headers)
+        if resp.status in range(200, 300):
+            return resp, 0
+        resp.read()
+        resp.close()
+        if resp.status == 404:
+            # Server doesn't know this upload id; start over.
+            return None, 0
+        if resp.status != 308:
+            raise HTTPError(resp.status, resp.reason, "Could not resume upload: %s %s"%(resp.status, resp.reason))
+        r = resp.getheader('Range')
+        if not r:
+            return None, 0
+        return None, int(r.rpartition('-')[2]) + 1
+
+    ##### Checkpoints #####
+
+    def _checkpoint_filename(self, fileobj):
+        return fileobj.name + ".upload.json"
+
+    def _checkpoint_load(self, fileobj, st):
+        try:
+            checkpoint = json.load(open(self._checkpoint_filename(fileobj), "r"))
+        except:
+            checkpoint = {}
+        if checkpoint.get('size') != st.st_size or checkpoint.get('mtime') != st.st_mtime:
+            checkpoint = {
+                'upload_id': uuid.uuid4().hex,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'blocks': []
+            }
+        return checkpoint
+
+    def _checkpoint_verify(self, fileobj, checkpoint, offset):
+        """Trim blocks past the server offset; check the last block is unchanged."""
+        blocks = [i for i in checkpoint['blocks'] if i['offset']+i['length'] <= offset]
+        if blocks:
+            last = blocks[-1]
+            fileobj.seek(last['offset'])
+            md5 = hashlib.md5()
+            remaining = last['length']
+            while remaining > 0:
+                chunk = fileobj.read(min(remaining, 1024*1024))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if md5.hexdigest() != last['md5']:
+                self.log("File changed since the last checkpoint; restarting upload")
+                blocks = []
+                offset = 0
+                checkpoint['upload_id'] = uuid.uuid4().hex
+                self.headers['X-Upload-Id'] = checkpoint['upload_id']
+        elif offset:
+            # Server has bytes we can't verify; restart.
+            offset = 0
+            checkpoint['upload_id'] = uuid.uuid4().hex
+            self.headers['X-Upload-Id'] = checkpoint['upload_id']
+        checkpoint['blocks'] = blocks
+        return offset
+
+    def _checkpoint_add(self, fileobj, checkpoint, block):
+        if not block['length']:
+            return
+        checkpoint['blocks'].append({
+            'offset': block['offset'],
+            'length': block['length'],
+            'md5': block['md5'].hexdigest()
+        })
+        try:
+            json.dump(checkpoint, open(self._checkpoint_filename(fileobj), "w"))
+        except (IOError, OSError), e:
+            self.log("Could not write upload checkpoint: %s"%e)
+
+    def _checkpoint_remove(self, fileobj):
+        try:
+            os.unlink(self._checkpoint_filename(fileobj))
+        except OSError:
+            pass
+
+class SegmentedPutHandler(PutHandler):
+    """Send one large file as byte ranges over several concurrent connections.
+
+    Each segment is a PUT with a Content-Length body and the headers
+    X-Upload-Id, X-Upload-Segment (index) and "Content-Range: bytes
+    <start>-<end>/<size>"; the server stores it and replies 2xx or 308.
+    Failed segments are retried individually. When all segments are
+    stored, an empty PUT with "X-Upload-Commit: <count>" asks the server
+    to assemble the file; its response is the response for the upload.
+    """
+    def __init__(self, *args, **kwargs):
+        self.segmentsize = kwargs.pop('segmentsize', None) or int(emdash.config.get('segmentsize', 256)) * 1024 * 1024
+        self.parallel = kwargs.pop('parallel', None) or int(emdash.config.get('parallel', 4))
+        self.retries = kwargs.pop('retries', 3)
+        super(SegmentedPutHandler, self).__init__(*args, **kwargs)
+
+    def open(self, path, data=None):
+        path, fileobj = self._prepare(path, data)
+        size = filesize(fileobj)
+        if size <= self.segmentsize or self.parallel < 2:
+            send = lambda http: self._send_chunked(http, fileobj, size)
+            return self._request('PUT', path, self.headers, send=send, rewind=self._rewinder(fileobj))
+
+        self.headers.pop('Transfer-Encoding', None)
+        self.headers['X-Upload-Id'] = uuid.uuid4().hex
+        segments = [(i, offset, min(self.segmentsize, size-offset)) for i, offset in enumerate(range(0, size, self.segmentsize))]
+        count = len(segments)
+        self.log("Uploading %s bytes in %s segments over %s connections"%(size, count, self.parallel))
+        
+        state = {'sent':0, 'errors':[]}
+        lock = threading.Lock()
+        job = emdash.engine.current()
+        def progress(count):
+            with lock:
+                state['sent'] += count
+                sent = state['sent']
+            self.progress(sent/float(size))
+        def worker():
+            # Stop with the job that started us.
+            emdash.engine.adopt(job)
+            f = open(fileobj.name, "rb")
+            try:
+                while not state['errors']:
+                    with lock:
+                        if not segments:
+                            return
+                        segment = segments.pop(0)
+                    try:
+                        self._segment_retry(path, f, size, segment, progress)
+                    except Exception, e:
+                        with lock:
+                            state['errors'].append((segment[0], e))
+            finally:
+                f.close()
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.parallel, len(segments)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if state['errors']:
+            index, e = state['errors'][0]
+            if isinstance(e, emdash.engine.Cancelled):
+                raise e
+            msg = "Upload failed on segment %s: %s"%(index, e)
+            if getattr(e, 'status', None):
+                raise HTTPError(e.status, e.reason, msg)
+            raise httplib.HTTPException, msg
+
+        # All segments stored; ask the server to assemble the file.
+        headers = dict(self.headers)
+        headers['Content-Length'] = '0'
+        headers['X-Upload-Commit'] = str(count)
+        return self._request('PUT', path, headers)
+
+    def _segment_retry(self, path, fileobj, size, segment, progress):
+        index, offset, length = segment
+        for attempt in range(self.retries+1):
+            sent = []
+            def callback(count):
+                sent.append(count)
+                progress(count)
+            try:
+                return self._segment_send(path, fileobj, size, segment, callback)
+            except (socket.error, httplib.HTTPException), e:
+                # Roll back this segment's progress before trying again.
+                progress(-sum(sent))
+                kind = emdash.retry.classify(e)
+                if attempt >= self.retries or kind not in (emdash.retry.TRANSIENT, emdash.retry.SERVER):
+                    raise
+                delay = emdash.retry.default_policy.delay(attempt+1)
+                self.log("Segment %s failed (%s); retrying in %0.1f s"%(index, e, delay))
+                time.sleep(delay)
+
+    def _segment_send(self, path, fileobj, size, segment, callback):
+        index, offset, length = segment
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(length)
+        headers['Content-Range'] = 'bytes %s-%s/%s'%(offset, offset+length-1, size)
+        headers['X-Upload-Segment'] = str(index)
+        host, http = self._connect()
+        http.request('PUT', path, headers=headers)
+        fileobj.seek(offset)
+        remaining = length
+        sizer = self._sizer(http)
+        while remaining > 0:
+            chunk = fileobj.read(min(sizer.chunksize, remaining))
+            if not chunk:
+                raise IOError, "File truncated during upload: %s"%fileobj.name
+            self._send(http, sizer, len(chunk), chunk)
+            remaining -= len(chunk)
+            callback(len(chunk))
+        resp = self._response(host, http)
+        resp.read()
+        resp.close()
+        if resp.status not in range(200, 300) and resp.status != 308:
+            raise HTTPError(resp.status, resp.reason)
 
 class PostHandler(Handler):
     # Loosely based on http://code.activestate.com/recipes/146306/
@@ -105,75 +1421,59 @@ class PostHandler(Handler):
         self.boundary = mimetools.choose_boundary()
         self.headers['Content-Type'] = 'multipart/form-data; boundary=%s'%self.boundary
         
-        # In the future, use Transfer-Encoding:Chunked as in PutHandler.
-        # This should work, but I don't know how well it's supported when also using mutlipart/form-data.
-        # Important note:
-        #   This will create a string the size of all the files to upload. This can crash on 32-bit Python,
-        #   especially on Windows.
-        body = self.encode_multipart_formdata(data, files)
-
-        # seek to end to get size...
-        body.seek(0, os.SEEK_END)
-        size = body.tell()
-        body.seek(0)
+        # The body is streamed from disk as it is sent; only the part
+        # headers are held in memory. Content-Length is known up front.
+        state = {'body':self.encode_multipart_formdata(data, files)}
+        size = state['body'].size
         self.headers['Content-Length'] = str(size)
-        
-        # Open connection
-        # httplib doesn't take scheme://
-        host = emdash.config.get('host').partition('://')[-1] 
-        http = httplib.HTTPConnection(host)
-        http.request('POST', path, headers=self.headers)
 
-        # Upload in chunks so we can show progress.
-        chunksize = 128*1024        
-        pos = 0
-        while True:
-            try:
-                chunk = body.read(chunksize)
+        def send(http):
+            # Upload in chunks so we can show progress.
+            body = state['body']
+            sizer = self._sizer(http)
+            pos = 0
+            while True:
+                chunk = body.read(sizer.chunksize)
                 pos = pos+len(chunk)
-                http.send(chunk)
-                self.log(progress=(pos/float(size or 1)))
-            except socket.error:
-                raise
-            if not chunk:
-                break
+                self._send(http, sizer, len(chunk), chunk)
+                self._progress(sizer, pos/float(size or 1))
+                if not chunk:
+                    break
 
-        # Return response...
-        return http.getresponse()
+        # The body can be sent again if all its files can seek back.
+        rewinders = [self._rewinder(i) for values in files.values() for i in self._check_iterable(values)]
+        rewind = None
+        if all(rewinders):
+            def rewind():
+                for i in rewinders:
+                    i()
+                state['body'] = self.encode_multipart_formdata(data, files)
+
+        # Send over a pooled connection, and return the response.
+        return self._request('POST', path, self.headers, send=send, rewind=rewind)
                 
     def encode_multipart_formdata(self, data, files):
-        buf = StringIO.StringIO()
+        body = MultipartBody()
         for(key, values) in data.items()+files.items():
             values = self._check_iterable(values)
             for value in values:
                 if hasattr(value, 'read'):
-                    # Allow alternate names for upload.
-                    try:
-                        filename = value.name_upload
-                    except AttributeError:
-                        filename = value.name                    
-                    buf.write('--%s\r\n'%self.boundary)
-                    buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n'%(key, unicode(os.path.basename(filename)).encode('utf-8')))
-                    buf.write('Content-Type: application/octet-stream\r\n')
-                    buf.write('\r\n')
-
-                    value.seek(0)
-                    chunk = value.read()
-                    total = len(chunk)
-                    while chunk:
-                        buf.write(chunk)
-                        chunk = value.read(1024*1024)
-                        total += len(chunk)
-                    buf.write('\r\n')
+                    filename = filename_upload(value)
+                    body.add_string('--%s\r\n'%self.boundary)
+                    body.add_string('Content-Disposition: form-data; name="%s"; filename="%s"\r\n'%(key, unicode(os.path.basename(filename)).encode('utf-8')))
+                    body.add_string('Content-Type: application/octet-stream\r\n')
+                    body.add_string('\r\n')
+                    body.add_file(value, digest=self._digest(value))
+                    body.add_string('\r\n')
                 else:
-                    buf.write('--%s\r\n'%self.boundary)
-                    buf.write('Content-Disposition: form-data; name="%s"\r\n'%key)
-                    buf.write('\r\n')
-                    buf.write(unicode(value).encode('utf-8'))
-                    buf.write('\r\n')
-
-        buf.write('--%s--\r\n\r\n'%self.boundary)
-        return buf
+                    body.add_string('--%s\r\n'%self.boundary)
+                    body.add_string('Content-Disposition: form-data; name="%s"\r\n'%key)
+                    body.add_string('\r\n')
+                    body.add_string(unicode(value).encode('utf-8'))
+                    body.add_string('\r\n')
+
+        body.add_string('--%s--\r\n\r\n'%self.boundary)
+        return body
     
     def _check_iterable(self, value):
         # Grumble..
@@ -16,6 +16,7 @@ import json
 from PyQt4 import QtGui, QtCore, Qt
 
 # emdash imports
+import emdash.bandwidth
 import emdash.config
 import emdash.log
 import emdash.emmodels
@@ -43,6 +44,28 @@ class UploadConfig(emdash.config.Config):
             help="Specify upload target directly.")
         parser.add_argument("--watch",
             help="Watch directory for files to upload")
+        parser.add_argument("--resume", action="store_true",
+            help="Use resumable uploads for large files (requires server support)")
+        parser.add_argument("--parallel", type=int,
+            help="Upload large files as segments over this many connections (requires server support)")
+        parser.add_argument("--segmentsize", type=int,
+            help="Segment size in MB for parallel uploads")
+        parser.add_argument("--compress",
+            help="Compress uploads on the fly: gzip, zstd, lz4 (requires server support for Content-Encoding on uploads)")
+        parser.add_argument("--jobs", "-j", type=int,
+            help="Number of files to upload at once")
+        parser.add_argument("--readahead", type=int,
+            help="Read-ahead buffers per upload; 0 disables (default: 4 on network filesystems)")
+        parser.add_argument("--readahead_size", type=int,
+            help="Read-ahead buffer size in MB")
+        parser.add_argument("--sidecar", action="store_true",
+            help="Also write a <file>.json sidecar for each uploaded file")
+        parser.add_argument("--ledger",
+            help="Upload ledger database (default: ~/.emdash/uploads.db)")
+        parser.add_argument("--nodedup", action="store_true",
+            help="Upload files even if the same content was uploaded before")
+        parser.add_argument("--dedup_server", action="store_true",
+            help="Before uploading, ask the server for a file with the same md5")
 
 def main(appclass=None, configclass=None):
     appclass = appclass or BaseUpload
@@ -99,9 +122,15 @@ class Options(QtGui.QDialog):
         self.widgets['handler'] = QtGui.QLineEdit();
         self.widgets['microscope'] = QtGui.QLineEdit();
         self.widgets['session_protocol'] = QtGui.QLineEdit();
+        self.widgets['limit_upload'] = QtGui.QLineEdit();
+        self.widgets['limit_download'] = QtGui.QLineEdit();
         for k, v in self.widgets.items():
             v.setText(emdash.config.get(k) or "")
 
+        # Bandwidth limits take effect right away.
+        for k in ['limit_upload', 'limit_download']:
+            self.widgets[k].editingFinished.connect(functools.partial(self.set_limit, k))
+
         f = self.ui.layout_options
         f.addRow("Host:", self.widgets['host'])
         self._addtext(f, """The address to the EMEN2 server.""")
@@ -114,8 +143,21 @@ class Options(QtGui.QDialog):
         f.addRow("Microscope:", self.widgets['microscope'])
         self._addtext(f, """This is the record ID for the microscope. New sessions will be created as children of this record. EMDash will also check for child record with date-specific configuration.""")
         self._addhr(f)
+        f.addRow("Upload limit:", self.widgets['limit_upload'])
+        f.addRow("Download limit:", self.widgets['limit_download'])
+        self._addtext(f, """Bandwidth limits in bytes per second, shared by all transfers. Use a K, M or G suffix, e.g. "10M". Leave empty for no limit. These apply immediately.""")
+        self._addhr(f)
         self._addtext(f, """You must restart EMDash for changes to take effect. EMDash will quit when you save this form.""")
 
+    def set_limit(self, key):
+        value = unicode(self.widgets[key].text())
+        try:
+            emdash.bandwidth.set_limit(key.partition('_')[2], value)
+        except ValueError:
+            emdash.log.error("Invalid bandwidth limit: %s"%value)
+            return
+        emdash.config.set(key, value)
+
     def accept(self):
         ret = {}
         for k,v in self.widgets.items():
@@ -235,6 +277,7 @@ class BaseTransport(QtGui.QMainWindow):
     # Updated record
     signal_newfile = QtCore.pyqtSignal(unicode, object)
     signal_status = QtCore.pyqtSignal(unicode, object)
+    signal_progress = QtCore.pyqtSignal(object)
     signal_exception = QtCore.pyqtSignal(unicode)
 
     # Files
@@ -262,8 +305,9 @@ class BaseTransport(QtGui.QMainWindow):
         self.recnames = {}
         self.settings = {}
 
-        # Listen for progress events.
+        # Listen for status messages and (batched) progress events.
         emdash.log.add_listener(self.log_listener)
+        emdash.log.add_progress_listener(self.progress_listener)
 
         ###### Queue
         self.queue = Queue.Queue()
@@ -291,6 +335,7 @@ class BaseTransport(QtGui.QMainWindow):
         self.signal_newfile.connect(self.queuemodel.newfile, type=QtCore.Qt.QueuedConnection) # add to table
         self.signal_newfile.connect(self.ui.tree_files.newfile, type=QtCore.Qt.QueuedConnection) # scroll to bottom
         self.signal_status.connect(self.queuemodel.file_status, type=QtCore.Qt.QueuedConnection) # update table
+        self.signal_progress.connect(self.queuemodel.file_progress, type=QtCore.Qt.QueuedConnection) # update progress bars
 
         # New upload target
         self.signal_target.connect(self.queuemodel.set_target, type=QtCore.Qt.QueuedConnection)
@@ -300,6 +345,7 @@ class BaseTransport(QtGui.QMainWindow):
         self.fspollthread = emdash.emthreads.FSPollThread()
         self.fspollthread.signal_newfile.connect(self.newfile, type=QtCore.Qt.QueuedConnection) # add to the upload queue
         self.signal_set_path.connect(self.fspollthread.set_path, type=QtCore.Qt.QueuedConnection) # set watch path
+        self.signal_set_path.connect(self.worker.set_path, type=QtCore.Qt.QueuedConnection) # retry forever while watching
         # todo: set_path has a watch keyword argument that will start the thread.
         # self.signal_set_path.connect(self.fspollthread.start, type=QtCore.Qt.QueuedConnection) # start polling
 
@@ -394,10 +440,14 @@ class BaseTransport(QtGui.QMainWindow):
 
     def log_listener(self, *msg, **kwargs):
         name = kwargs.get('name', None)
-        status = kwargs.get('progress') or ' '.join(map(unicode, msg))
-        if name:
+        status = ' '.join(map(unicode, msg))
+        if name and status:
             self.signal_status.emit(name, {'_status':status})
 
+    def progress_listener(self, batch):
+        # Called from the progress sampler thread, a few times per second.
+        self.signal_progress.emit(batch)
+
     def log(self, *args, **kwargs):
         print args
 
@@ -500,6 +550,7 @@ class BaseTransport(QtGui.QMainWindow):
     @QtCore.pyqtSlot()
     def end_session(self):
         emdash.log.msg("Logging out!")
+        self.worker.engine.shutdown(cancel=True)
         emdash.config.db().auth.logout()
         self.close()
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 import sys
 import emdash.console
+import emdash.sync
 
 def print_help():
     print """%s <action>
 
-Actions available: upload, download
+Actions available: upload, download, sync
 For detailed help: %s <action> --help
     """%(sys.argv[0],sys.argv[0])
     
@@ -20,6 +21,8 @@ def main():
         emdash.console.upload()    
     elif action == 'download':
         emdash.console.download()
+    elif action == 'sync':
+        emdash.sync.main()
 
 
 if __name__ == "__main__":